@@ -1,13 +1,187 @@
 import asyncio
+import collections
+import contextlib
 import traceback
 import pathlib
+import time
+import uuid
 import hardware 
 import json
-import asyncio
-from zconf import ZListener, ZBrowser
-from aiozeroconf import Zeroconf
-from datetime import datetime
+from discovery_cache import DiscoveryCache
 from http_server import HttpServer
+from logger import Logger
+from metrics import Metrics
+from scheduler import Scheduler
+
+
+#
+# Device Registry
+# - indexes every hardware device by id and by name (original and renamed)
+#
+class DeviceRegistry:
+    def __init__(self, on_change=None):
+        self.devices = {}
+        self.owners = {}
+        self.names = {}
+        self.name_mapper = {}
+        self.on_change = on_change
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def get_names(self, device):
+        names = [device['name']]
+        if device['name'] in self.name_mapper:
+            names.append(self.name_mapper[device['name']])
+        return names
+
+    def _index_name(self, device):
+        for name in self.get_names(device):
+            # the first registered device keeps the name, like the old linear scan
+            if name not in self.names:
+                self.names[name] = device
+
+    def _unindex_name(self, device):
+        for name in self.get_names(device):
+            if self.names.get(name) is device:
+                self.names.pop(name)
+                # fall back to another device sharing the same name
+                for current in self.devices.values():
+                    if current is not device and name in self.get_names(current):
+                        self.names[name] = current
+                        break
+
+    def set_name_mapper(self, name_mapper):
+        self.name_mapper = name_mapper
+        self.names = {}
+        for device in self.devices.values():
+            self._index_name(device)
+        self._changed()
+
+    def add(self, owner, device):
+        if device['id'] in self.devices:
+            self.remove(device['id'])
+
+        self.devices[device['id']] = device
+        self.owners[device['id']] = owner
+        if 'name' in device:
+            self._index_name(device)
+        self._changed()
+
+    def remove(self, device_id):
+        device = self.devices.pop(device_id, None)
+        self.owners.pop(device_id, None)
+        if device and 'name' in device:
+            self._unindex_name(device)
+        if device:
+            self._changed()
+        return device
+
+    def remove_owner(self, owner):
+        for device_id in [k for k, v in self.owners.items() if v is owner]:
+            self.remove(device_id)
+
+    def rename(self, device, name):
+        if device.get('name') == name:
+            return
+        registered = self.devices.get(device['id']) is device
+        if registered and 'name' in device:
+            self._unindex_name(device)
+        device['name'] = name
+        if registered:
+            self._index_name(device)
+            self._changed()
+
+    def get(self, device_id):
+        return self.devices.get(device_id)
+
+    def get_owner(self, device_id):
+        return self.owners.get(device_id)
+
+    def get_by_name(self, name):
+        return self.names.get(name)
+
+    def get_devices(self):
+        return list(self.devices.values())
+
+
+#
+# Device Action Queue
+# - at most one running and one pending action per device
+# - a new action replaces the pending one (enable, disable, enable -> enable)
+# - callers asking for an action that is already queued share its result
+# - without coalescing (buttons) every press runs, in order
+#
+class DeviceActionQueue:
+    def __init__(self, execute, coalesce=True):
+        self.execute = execute
+        self.coalesce = coalesce
+        self.running = None
+        self.pending = None
+        self.backlog = collections.deque()
+        self.task = None
+
+    def is_idle(self):
+        return self.running is None
+
+    def submit(self, action):
+        loop = asyncio.get_event_loop()
+
+        if self.running is None:
+            self.running = [action, loop.create_future()]
+            return self.running[1], False
+
+        if not self.coalesce:
+            self.backlog.append([action, loop.create_future()])
+            return self.backlog[-1][1], False
+
+        if self.running[0] == action:
+            # back to what is already happening, the pending change is dropped
+            if self.pending:
+                self._forward(self.running[1], self.pending[1])
+                self.pending = None
+            return self.running[1], True
+
+        if self.pending is None:
+            self.pending = [action, loop.create_future()]
+            return self.pending[1], False
+
+        self.pending[0] = action
+        return self.pending[1], True
+
+    def _forward(self, source, target):
+        def done(future):
+            if target.done():
+                return
+            if future.exception():
+                target.set_exception(future.exception())
+            else:
+                target.set_result(future.result())
+        source.add_done_callback(done)
+
+    async def pump(self):
+        while self.running:
+            action, future = self.running
+            try:
+                result = await self.execute(action)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                for _, waiting in filter(None, [self.running, self.pending, *self.backlog]):
+                    waiting.cancel()
+                self.running = self.pending = None
+                self.backlog.clear()
+                raise
+            except Exception as exception:
+                if not future.done():
+                    future.set_exception(exception)
+
+            if self.backlog:
+                self.running = self.backlog.popleft()
+            else:
+                self.running = self.pending
+                self.pending = None
 
 
 class Core:
@@ -22,10 +196,91 @@ class Core:
         self.mdns = {}
         self.dashboard_devices = []
         self.hardware = []
+        self.hardware_tasks = {}
+        self.zeroconf = None
+        self.zeroconf_browsers = []
+        self.reload_lock = asyncio.Lock()
+        self.registry = DeviceRegistry(self.topology_changed)
+        self.action_queues = {}
+        self.stopped = asyncio.Event()
         self.http_server = None
-        self.log_history_size = 250
-        self.log_history = []
+        self.logger = Logger()
+        self.discovery_cache = DiscoveryCache(pathlib.Path(__file__).parent / 'discovery_cache.json')
+
+        # timings for imports, configuration and driver start
+        self.created = time.perf_counter()
+        self.timeline = collections.deque(maxlen=100)
+
+        self.metrics = Metrics()
+        self.metric_action_duration = self.metrics.histogram(
+            "magicwand_action_duration_seconds", "Device action latency", ("device", "action"))
+        self.metric_actions = self.metrics.counter(
+            "magicwand_actions_total", "Device actions by result", ("device", "action", "result"))
+        self.metric_actions_coalesced = self.metrics.counter(
+            "magicwand_actions_coalesced_total", "Device actions merged into a queued one", ("device", "action"))
+        self.metric_log_records = self.metrics.counter(
+            "magicwand_log_records_total", "Log records by source and level", ("source", "level"))
+        self.metrics.gauge(
+            "magicwand_executor_queue_depth", "Work items waiting on each driver executor", ("driver",),
+            collect=self._collect_executor_depth)
+
+        self.scheduler = Scheduler(self)
+
+        # bumped on every device state or topology change
+        self.instance = uuid.uuid4().hex[:8]
+        self.state_version = 0
+        self.device_list_cache = None
+        self.device_list_cache_version = -1
+        self.device_listeners = []
+
+    def add_device_listener(self, listener):
+        self.device_listeners.append(listener)
+
+    def remove_device_listener(self, listener):
+        if listener in self.device_listeners:
+            self.device_listeners.remove(listener)
+
+    def _notify_device_listeners(self, device):
+        for listener in list(self.device_listeners):
+            try:
+                listener(device)
+            except Exception as exception:
+                self.log_exception('device listener', exception)
+
+    def topology_changed(self):
+        self.state_version += 1
+        # listeners receive None when devices were added, removed or renamed
+        self._notify_device_listeners(None)
+
+    def device_state_changed(self, device):
+        self.state_version += 1
+        self._notify_device_listeners(device)
+
+
+    @contextlib.contextmanager
+    def profile(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.timeline.append({
+                'phase': phase,
+                'at': round(start - self.created, 3),
+                'seconds': round(end - start, 3)
+            })
+
+    def stop(self, restart=False):
+        self.restart = restart
+        self.running = False
+        self.stopped.set()
+        self.scheduler.notify()
 
+        for current in self.hardware:
+            current.request_stop()
+
+    async def wait_stopped(self):
+        await self.stopped.wait()
 
     def add_mdns(self, name, server, ip, port):
         self.log(f"mDNS {name} added @ {server} {ip}:{port}")
@@ -36,6 +291,22 @@ class Core:
             'port': port
         }
         self.mdns[name] = element
+        self.discovery_cache.put('mdns', name, server=server, ip=ip, port=port)
+
+        for current in self.hardware:
+            current.mdns_changed(name)
+
+    def load_cached_mdns(self):
+        # known services are usable before zeroconf finds them again
+        for name, record in self.discovery_cache.get_all('mdns').items():
+            if name not in self.mdns:
+                self.log(f"mDNS {name} cached @ {record['server']} {record['ip']}:{record['port']}")
+                self.mdns[name] = {
+                    'name': name,
+                    'server': record['server'],
+                    'ip': record['ip'],
+                    'port': record['port']
+                }
 
     def remove_mdns(self, name):
         self.log(f"mDNS {name} removed")
@@ -49,25 +320,30 @@ class Core:
 
 
     def clear_log(self):
-        self.log_history = []
+        self.logger.clear()
         self.log("log cleared")
 
-    def log(self, message):
-        now = datetime.now()
-        timestamp = now.isoformat(sep=' ', timespec='milliseconds')
+    def log(self, message, level='info', source=None, device=None):
+        self.logger.log(message, level, source, device)
+        self.metric_log_records.inc(source or "Core", level)
 
-        message = timestamp + " " + str(message)
-        self.log_history.extend(message.splitlines())
-        self.log_history = self.log_history[-self.log_history_size:]
-
-        print(message)
+    def _collect_executor_depth(self):
+        depth = {}
+        for current in self.hardware:
+            executor = getattr(current, 'executor', None)
+            work_queue = getattr(executor, '_work_queue', None)
+            if work_queue is not None:
+                depth[(current.hardware_type(),)] = work_queue.qsize()
+        return depth
 
-    def log_exception(self, tag, exception):
+    def log_exception(self, tag, exception, source=None, device=None):
         data = tag + "\n" + "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
-        self.log(data)
+        self.log(data, 'error', source, device)
 
 
     def _handle_task_result(self, task):
+        if task.cancelled():
+            return
         exception = task.exception()
         if exception:
             self.log_exception('handle_task_result', exception)
@@ -78,130 +354,262 @@ class Core:
         return task
 
 
-    async def pump(self):
-        self.log("Core setting up...")
-
-        configuration_path = pathlib.Path(__file__).parent / 'configuration.json'
-        configuration_file = open(configuration_path, "r")
-        self.configuration = json.loads(configuration_file.read())
-        configuration_file.close()
+    def load_configuration(self):
+        with self.profile("configuration"):
+            configuration_path = pathlib.Path(__file__).parent / 'configuration.json'
+            configuration_file = open(configuration_path, "r")
+            configuration = json.loads(configuration_file.read())
+            configuration_file.close()
+        return configuration
+
+    def apply_settings(self, configuration):
+        groups = configuration.get("Groups", [])
+        dashboard_devices = configuration.get("DashboardDevices", [])
+
+        name_mapper = {}
+        for record in configuration.get("Names", []):
+            if "device_name" in record:
+                name_mapper[record['device_name']] = record['renamed']
+
+        # swap everything at once, the registry bumps the state version
+        self.groups = groups
+        self.dashboard_devices = dashboard_devices
+        self.name_mapper = name_mapper
+        self.registry.set_name_mapper(name_mapper)
+
+        if "Log" in configuration:
+            log_configuration = configuration["Log"]
+            if "size" in log_configuration:
+                self.logger.resize(log_configuration["size"])
+            if "file" in log_configuration:
+                self.logger.open_file(pathlib.Path(__file__).parent / log_configuration["file"])
+
+        if "DiscoveryCache" in configuration:
+            cache_configuration = configuration["DiscoveryCache"]
+            if "file" in cache_configuration:
+                self.discovery_cache.path = pathlib.Path(__file__).parent / cache_configuration["file"]
+            if "ttl" in cache_configuration:
+                self.discovery_cache.ttl = cache_configuration["ttl"]
+
+    def get_hardware(self, hardware_type):
+        for current in self.hardware:
+            if current.hardware_type() == hardware_type:
+                return current
+        return None
 
-        if "Groups" in self.configuration:
-            self.groups = self.configuration["Groups"]
+    def start_hardware(self, hardware_type):
+        current = hardware.create(self, hardware_type)
+        self.hardware.append(current)
+        self.hardware_tasks[current] = self.create_task(hardware.run(self, current))
 
-        if "Names" in self.configuration:
-            names = self.configuration["Names"]
-            for record in names:
-                if "device_name" in record:
-                    self.name_mapper[record['device_name']] = record['renamed']
+        if hardware_type == "AndroidHardware":
+            self.start_zeroconf()
 
-        if "DashboardDevices" in self.configuration:
-            self.dashboard_devices = self.configuration["DashboardDevices"]
-        
-        use_zeroconf = False
+    async def stop_hardware(self, current):
+        current.request_stop()
+        try:
+            await self.hardware_tasks.pop(current)
+        except Exception:
+            # already logged by the task done callback
+            pass
+        self.hardware.remove(current)
 
-        #
-        # Add hardware
-        #
-        if "DummyHardware" in self.configuration:
-            self.hardware.append(hardware.DummyHardware(self))
+        if current.hardware_type() == "AndroidHardware":
+            await self.stop_zeroconf()
 
-        if "MultiDeviceHardware" in self.configuration:
-            self.hardware.append(hardware.MultiDeviceHardware(self))
+    def start_zeroconf(self):
+        if self.zeroconf:
+            return
 
-        if "ButtonHardware" in self.configuration:
-            self.hardware.append(hardware.ButtonHardware(self))
+        self.log("enabling zeroconf")
+        self.load_cached_mdns()
 
-        if "CommandHardware" in self.configuration:        
-            self.hardware.append(hardware.CommandHardware(self))
-        
-        if "TuyaCloudHardware" in self.configuration:
-            self.hardware.append(hardware.TuyaCloudHardware(self))
+        with self.profile("import zeroconf"):
+            from zconf import ZListener, ZBrowser
+            from aiozeroconf import Zeroconf
 
-        if "TuyaLocalHardware" in self.configuration:
-            self.hardware.append(hardware.TuyaLocalHardware(self))
+        loop = asyncio.get_event_loop()
+        self.zeroconf = Zeroconf(loop)
+        zeroconf_listener = ZListener(self)
+        self.zeroconf_browsers = [
+            ZBrowser(self.zeroconf, "_adb._tcp.local.", zeroconf_listener),
+            #ZBrowser(self.zeroconf, "_googlecast._tcp.local.", zeroconf_listener),
+            ZBrowser(self.zeroconf, "_androidtvremote2._tcp.local.", zeroconf_listener),
+        ]
+
+    async def stop_zeroconf(self):
+        if self.zeroconf is None:
+            return
+
+        for current in self.zeroconf_browsers:
+            current.cancel()
+        await self.zeroconf.close()
+
+        self.zeroconf = None
+        self.zeroconf_browsers = []
+
+    async def reload(self):
+        async with self.reload_lock:
+            self.log("Core reloading configuration...")
+
+            try:
+                configuration = self.load_configuration()
+            except Exception as exception:
+                self.log_exception("failed to read configuration", exception)
+                return False
+
+            previous = self.configuration
+
+            if configuration.get("HttpServer") != previous.get("HttpServer"):
+                self.log("HttpServer configuration changed, restarting")
+                self.stop(restart=True)
+                return True
+
+            self.configuration = configuration
+            self.apply_settings(configuration)
+
+            # only the hardware blocks that changed are restarted
+            for hardware_type in hardware.DRIVERS:
+                if previous.get(hardware_type) == configuration.get(hardware_type):
+                    continue
+
+                current = self.get_hardware(hardware_type)
+                if current:
+                    self.log(f"Reload stopping {hardware_type}")
+                    await self.stop_hardware(current)
+
+                if hardware_type in configuration:
+                    self.log(f"Reload starting {hardware_type}")
+                    self.start_hardware(hardware_type)
+
+            self.log("Core reload completed")
+            return True
 
-        if "MiioYeelightHardware" in self.configuration:
-            self.hardware.append(hardware.MiioYeelightHardware(self))
+    async def pump(self):
+        self.log("Core setting up...")
 
-        if "AndroidHardware" in self.configuration:
-            self.hardware.append(hardware.AndroidHardware(self))
-            use_zeroconf = True
+        self.configuration = self.load_configuration()
+        self.apply_settings(self.configuration)
 
-        all_tasks = []
+        with self.profile("discovery cache"):
+            try:
+                count = self.discovery_cache.load()
+                self.log(f"Discovery cache loaded, {count} records")
+            except Exception as exception:
+                self.log_exception("failed to read the discovery cache", exception)
 
         self.log("Core starting pump...")
-        loop = asyncio.get_event_loop()
 
         #
         # Web Server
         #
         self.http_server = HttpServer()
         http_server_task = self.create_task(self.http_server.run(self))
-        all_tasks.append(http_server_task)
 
         #
-        # run hardware
+        # Scheduler
         #
-        hardware_tasks = []
-        for current in self.hardware:
-            hardware_task = self.create_task(hardware.run(self, current))
-            hardware_tasks.append(hardware_task)
-            all_tasks.append(hardware_task)
+        scheduler_task = self.create_task(self.scheduler.run())
+        self.scheduler.add_job("discovery_cache", 30.0, self.save_discovery_cache, 30.0)
 
         #
-        # Zero Conf
+        # run hardware
         #
-        if use_zeroconf:
-            self.log("enabling zeroconf")
-            
-            zeroconf = Zeroconf(loop)
-            zeroconf_listener = ZListener(self)
-            zeroconf_browsers = [
-                ZBrowser(zeroconf, "_adb._tcp.local.", zeroconf_listener),
-                #ZBrowser(zeroconf, "_googlecast._tcp.local.", zeroconf_listener),
-                ZBrowser(zeroconf, "_androidtvremote2._tcp.local.", zeroconf_listener),
-            ]
+        for hardware_type in hardware.DRIVERS:
+            if hardware_type in self.configuration:
+                self.start_hardware(hardware_type)
 
-        while self.running:
-            await asyncio.sleep(1)
-            #los = await ZeroconfServiceTypes.find(zeroconf,timeout=0.5)
-            #print ("Found {}".format(los))
+        await self.wait_stopped()
+        #los = await ZeroconfServiceTypes.find(zeroconf,timeout=0.5)
+        #print ("Found {}".format(los))
 
         self.log("Core Shutting down")
 
-        if use_zeroconf:
-            for current in zeroconf_browsers:
-                current.cancel()
-            await zeroconf.close()
+        await self.stop_zeroconf()
 
-        await asyncio.gather(*all_tasks)
+        await asyncio.gather(http_server_task, scheduler_task, *self.hardware_tasks.values())
+        await self.save_discovery_cache()
         self.log("Core shutdown completed")
+        self.logger.stop()
+
+    async def save_discovery_cache(self):
+        try:
+            self.discovery_cache.save()
+        except Exception as exception:
+            self.log_exception("failed to write the discovery cache", exception)
 
     async def run_device_action(self, device_id, action):
-        for current in self.hardware:
-            if current.get_device(device_id):
-                result = await current.run_action(device_id, action)
-                if result:
-                    current.complete_action(device_id, action)
-                return result
-                
-        return False
+        if self.registry.get_owner(device_id) is None:
+            return False
+
+        queue = self.action_queues.get(device_id)
+        if queue is None:
+            # a button press is an event, not a state, repeated presses all run
+            coalesce = self.registry.get(device_id).get('type') != 'button'
+            queue = DeviceActionQueue(lambda current: self._execute_device_action(device_id, current), coalesce)
+            self.action_queues[device_id] = queue
+
+        future, coalesced = queue.submit(action)
+        if coalesced:
+            self.metric_actions_coalesced.inc(device_id, action)
+        if queue.task is None:
+            queue.task = self.create_task(self._pump_action_queue(device_id, queue))
+
+        # a caller going away does not cancel the action shared with others
+        return await asyncio.shield(future)
+
+    async def _pump_action_queue(self, device_id, queue):
+        try:
+            await queue.pump()
+        finally:
+            queue.task = None
+            if self.action_queues.get(device_id) is queue:
+                self.action_queues.pop(device_id)
+
+    async def _execute_device_action(self, device_id, action):
+        owner = self.registry.get_owner(device_id)
+        if owner is None:
+            return False
+
+        start = time.perf_counter()
+        result = False
+        try:
+            if owner.action_slots:
+                async with owner.action_slots:
+                    result = await owner.run_action(device_id, action)
+            else:
+                result = await owner.run_action(device_id, action)
+        finally:
+            self.metric_action_duration.observe(time.perf_counter() - start, device_id, action)
+            self.metric_actions.inc(device_id, action, "ok" if result else "error")
+
+        if result:
+            owner.complete_action(device_id, action)
+        return result
+
+    async def run_device_actions(self, actions):
+        # every (device_id, action) pair runs concurrently, limited per driver
+        results = await asyncio.gather(
+            *[self.run_device_action(device_id, action) for device_id, action in actions],
+            return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                self.log_exception('run_device_actions', result)
+
+        return [bool(result) and not isinstance(result, Exception) for result in results]
 
     def get_groups(self):
         return self.groups
 
     def get_devices(self):
-        devices = []
-        for current in self.hardware:
-            devices.extend(current.get_devices())
-        return devices
+        return self.registry.get_devices()
+
+    def get_device(self, device_id):
+        return self.registry.get(device_id)
 
     def get_device_by_name(self, name):
-        devices = [d for d in self.get_devices() if d['name'] == name]
-        if len(devices) > 0:
-            return devices[0]
-        return None
+        return self.registry.get_by_name(name)
 
 
     def _devices_sort_func(self, element):
@@ -209,6 +617,13 @@ class Core:
         return element['group'] + " " + element['name']
 
     async def get_device_list(self):
+        if self.device_list_cache_version != self.state_version:
+            version = self.state_version
+            self.device_list_cache = self._build_device_list()
+            self.device_list_cache_version = version
+        return self.device_list_cache
+
+    def _build_device_list(self):
         devices = self.get_devices()
         groups = self.get_groups()
         records = []
@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+#
+# Discovery Cache
+# - remembers where devices were last found (ip, port, protocol version...)
+# - drivers are seeded from it on start, live discovery keeps it up to date
+# - records older than their ttl are ignored and dropped on the next save
+#
+class DiscoveryCache:
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.records = {}
+        self.dirty = False
+
+    def now(self):
+        return time.time()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                records = json.loads(file.read())
+        except FileNotFoundError:
+            return 0
+
+        now = self.now()
+        self.records = {}
+        for kind, entries in records.items():
+            self.records[kind] = dict((k, v) for k, v in entries.items() if not self._expired(v, now))
+        return sum(len(entries) for entries in self.records.values())
+
+    def save(self):
+        if not self.dirty:
+            return False
+
+        now = self.now()
+        records = {}
+        for kind, entries in self.records.items():
+            records[kind] = dict((k, v) for k, v in entries.items() if not self._expired(v, now))
+
+        # written aside and swapped, a crash never leaves half a file
+        temporary = str(self.path) + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(json.dumps(records, indent=4))
+        os.replace(temporary, self.path)
+
+        self.records = records
+        self.dirty = False
+        return True
+
+    def _expired(self, record, now):
+        ttl = record.get('ttl', self.ttl)
+        return now - record.get('seen', 0) > ttl
+
+    def get(self, kind, key):
+        record = self.records.get(kind, {}).get(key)
+        if record is None or self._expired(record, self.now()):
+            return None
+        return record
+
+    def get_all(self, kind):
+        now = self.now()
+        return dict((k, v) for k, v in self.records.get(kind, {}).items() if not self._expired(v, now))
+
+    def put(self, kind, key, ttl=None, **values):
+        entries = self.records.setdefault(kind, {})
+        previous = entries.get(key)
+
+        # an unchanged record only gets its timestamp refreshed
+        if previous is not None and previous.get('ttl') == ttl and \
+                all(previous.get(k) == v for k, v in values.items()):
+            self.touch(kind, key)
+            return
+
+        record = dict(values)
+        record['seen'] = round(self.now())
+        if ttl is not None:
+            record['ttl'] = ttl
+        entries[key] = record
+        self.dirty = True
+
+    def touch(self, kind, key):
+        # the device is still there, keeps its record from expiring,
+        # the timestamp alone is written at most once an hour
+        record = self.records.get(kind, {}).get(key)
+        if record is None:
+            return
+
+        now = round(self.now())
+        if now - record.get('seen', 0) > 3600:
+            record['seen'] = now
+            self.dirty = True
+
+    def remove(self, kind, key):
+        if self.records.get(kind, {}).pop(key, None) is not None:
+            self.dirty = True
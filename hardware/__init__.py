@@ -1,24 +1,36 @@
-import asyncio
-from hardware.base import DummyHardware
-from hardware.base import MultiDeviceHardware
-from hardware.base import ButtonHardware
-from hardware.command import CommandHardware
-from hardware.tuya_cloud import TuyaCloudHardware
-from hardware.tuya_local import TuyaLocalHardware
-from hardware.miio_yeelight import MiioYeelightHardware
-from hardware.android import AndroidHardware
+import importlib
+
+#
+# Drivers by configuration block, in start order
+# - a driver module is only imported when its block is configured
+#
+DRIVERS = {
+    "DummyHardware": "hardware.base",
+    "MultiDeviceHardware": "hardware.base",
+    "ButtonHardware": "hardware.base",
+    "CommandHardware": "hardware.command",
+    "TuyaCloudHardware": "hardware.tuya_cloud",
+    "TuyaLocalHardware": "hardware.tuya_local",
+    "MiioYeelightHardware": "hardware.miio_yeelight",
+    "AndroidHardware": "hardware.android"
+}
+
+def create(core, hardware_type):
+    with core.profile(f"import {hardware_type}"):
+        module = importlib.import_module(DRIVERS[hardware_type])
+    return getattr(module, hardware_type)(core)
 
 #
 # Run hardware Task
 #
 async def run(core, current_hardware):
     configuration = core.configuration[current_hardware.hardware_type()]
-    interval = 1
     
-    await current_hardware.start(configuration)
+    # periodic work is registered as scheduler jobs during start
+    with core.profile(f"start {current_hardware.hardware_type()}"):
+        await current_hardware.start(configuration)
 
-    while core.running:
-        await asyncio.sleep(interval)
-        await current_hardware.step()
+    await current_hardware.wait_stopped()
 
-    await current_hardware.stop()
\ No newline at end of file
+    await current_hardware.remove_jobs()
+    await current_hardware.stop()
@@ -9,6 +9,7 @@ from androidtv.adb_manager.adb_manager_async import ADBPythonAsync
 from androidtv.androidtv.androidtv_async import AndroidTVAsync
 
 from hardware.base import Hardware
+from hardware.health import DeviceHealth, next_delay
 
 class AndroidHardware(Hardware):
     def __init__(self, core):
@@ -17,9 +18,17 @@ class AndroidHardware(Hardware):
         self.signer = None
         self.adbkey = None
 
-        self.refresh_interval = 30.0
+        # tvs are polled every refresh_interval after a change, slower when stable
+        self.refresh_interval = 5.0
+        self.slow_refresh_interval = 30.0
 
     async def start(self, configuration):
+        if "refresh_interval" in configuration:
+            self.refresh_interval = configuration["refresh_interval"]
+
+        if "slow_refresh_interval" in configuration:
+            self.slow_refresh_interval = configuration["slow_refresh_interval"]
+
         #
         # ensure an adb key
         #
@@ -30,7 +39,7 @@ class AndroidHardware(Hardware):
 
         # Load the ADB key
         self.signer = await ADBPythonAsync.load_adbkey(self.adbkey)
-        self.core.log(f"using Python ADB implementation with adbkey='{self.adbkey}'")
+        self.log(f"using Python ADB implementation with adbkey='{self.adbkey}'")
 
 
         #
@@ -51,6 +60,7 @@ class AndroidHardware(Hardware):
                 "driver": None,
                 "status": None,
                 "last_status": None,
+                "health": DeviceHealth(self.refresh_interval, self.slow_refresh_interval),
 
                 "mdns": mdns
             }
@@ -77,9 +87,17 @@ class AndroidHardware(Hardware):
                 }
                 devices.append(device)
 
-        self.devices = devices
+        self.set_devices(devices)
         await super().start(configuration)
 
+        # mDNS changes wake the job, so drivers are created without polling
+        interval = self.slow_refresh_interval if self.refresh_interval > 0.0 else 60.0
+        self.poll_job = self.add_job("poll", interval, self.step)
+
+    def mdns_changed(self, name):
+        if name in self.tvs:
+            self.wake_job(self.poll_job)
+
 
     async def run_action(self, device_id, action):
         device = self.get_device(device_id)
@@ -89,10 +107,10 @@ class AndroidHardware(Hardware):
             action = device["command"]
 
         driver = tv['driver']
-        self.core.log(f"Android [{device['name']}] start {action}")
+        self.log(f"Android [{device['name']}] start {action}")
 
         if driver == None:
-            self.core.log(f"Hardware {device_id} not ready for action {action}")
+            self.log(f"Hardware {device_id} not ready for action {action}", 'warning', device_id)
             return False
 
         ok = False
@@ -105,17 +123,18 @@ class AndroidHardware(Hardware):
                     result = await driver.turn_on()
                 else:
                     result = await driver.adb_shell(action)
-                #self.core.log(f"Result {result}")  
+                #self.log(f"Result {result}")  
                 await driver.adb_close()
+                tv['health'].record_activity()
                 ok = True
             else:
-                self.core.log(f"Android [{device['name']}] unable to establish a connection") 
+                self.log(f"Android [{device['name']}] unable to establish a connection", 'warning', device) 
                 tv['driver'] = None
 
         except Exception as exception:
-            self.core.log_exception(f"Failed", exception)
+            self.log_exception(f"Failed", exception, device)
 
-        self.core.log(f"Android [{device['name']}] end")  
+        self.log(f"Android [{device['name']}] end")  
         return ok    
 
     async def step(self):
@@ -126,29 +145,44 @@ class AndroidHardware(Hardware):
             
             if mdns:
                 if tv['driver'] and tv['driver'].host != mdns['ip']:
-                    self.core.log(f"Android device {key} changed ip")
+                    self.log(f"Android device {key} changed ip")
                     tv['driver'] = None
 
                 if tv['driver'] == None:
                     driver = AndroidTVAsync(mdns['ip'], adbkey=self.adbkey, signer=self.signer)
                     tv['driver'] = driver
-                    self.core.log(f"Creating android device {key}")
+                    self.log(f"Creating android device {key}")
 
             
-            if tv['driver'] and self.refresh_interval > 0.0 and self.elapsed(tv['last_status'], self.refresh_interval):
+            health = tv['health']
+            if tv['driver'] and self.refresh_interval > 0.0 and health.is_due():
                 driver = tv['driver']
+                ok = False
                 try:
                     if await driver.adb_connect():
                         status = await tv['driver'].get_properties_dict()
                         tv['status'] = status
-                        tv['state'] = 'on' if status['screen_on'] else 'off'
-                        #self.core.log(f"state = {state}")
+                        changed = self.set_device_state(tv, 'on' if status['screen_on'] else 'off')
+                        #self.log(f"state = {state}")
                         await driver.adb_close()
+                        health.record_success(changed)
+                        self.core.discovery_cache.touch('mdns', key)
+                        ok = True
                     else:
-                        self.core.log(f"Android [{tv['name']}] unable to establish a connection") 
+                        self.log(f"Android [{tv['name']}] unable to establish a connection", 'warning', tv) 
                         tv['driver'] = None
                 except Exception as exception:
-                    self.core.log(f"Failed to update {tv['name']}")
-                    #self.core.log_exception(f"Failed", exception)
+                    self.log(f"Failed to update {tv['name']}", 'warning', tv)
+                    #self.log_exception(f"Failed", exception)
+
+                if not ok:
+                    # caught here, so the scheduler would not count it
+                    self.core.scheduler.metric_errors.inc(self.poll_job.name)
+                    if health.record_failure():
+                        self.log(f"Android [{tv['name']}] keeps failing, probing it every {health.probe_delay}s", 'warning', tv)
                     
-                tv['last_status'] = datetime.datetime.now()
\ No newline at end of file
+                tv['last_status'] = datetime.datetime.now()
+
+        # sleep until the next tv is due, mDNS changes wake the job earlier
+        if self.refresh_interval > 0.0:
+            return next_delay(tv['health'].delay() for tv in self.tvs.values() if tv['driver'])
\ No newline at end of file
@@ -2,6 +2,19 @@ import datetime
 import asyncio
 import concurrent.futures
 
+#
+# Action Result
+# - what a virtual device action returns, true when every child succeeded
+# - carries the per child results of this very call back to the caller
+#
+class ActionResult:
+    def __init__(self, ok, results):
+        self.ok = ok
+        self.results = results
+
+    def __bool__(self):
+        return self.ok
+
 #
 # Base Hardware Type
 #
@@ -12,6 +25,21 @@ class Hardware:
         self.configuration = None
         self.loop = None
         self.devices = []
+        self.jobs = []
+        self.poll_job = None
+        self.stopped = asyncio.Event()
+
+        # concurrent actions allowed on this driver, None for no limit
+        self.action_concurrency = 4
+        self.action_slots = None
+
+    def log(self, message, level='info', device=None):
+        device_id = device['id'] if isinstance(device, dict) else device
+        self.core.log(message, level, self.hardware_type(), device_id)
+
+    def log_exception(self, tag, exception, device=None):
+        device_id = device['id'] if isinstance(device, dict) else device
+        self.core.log_exception(tag, exception, self.hardware_type(), device_id)
 
     def elapsed(self, ts, seconds):
         if ts == None:
@@ -20,21 +48,110 @@ class Hardware:
         return delta > seconds
 
     def get_device(self, device_id):
-        devices = self.get_devices()
-        found = [i for i in devices if i["id"] == device_id]
-        if len(found) > 0:
-            return found[0]
-        return None
+        if self.core.registry.get_owner(device_id) is not self:
+            return None
+        return self.core.registry.get(device_id)
+
+    def set_devices(self, devices):
+        self.core.registry.remove_owner(self)
+        self.devices = devices
+        for device in devices:
+            self.core.registry.add(self, device)
+
+    def add_device(self, device):
+        self.devices.append(device)
+        self.core.registry.add(self, device)
+
+    def remove_device(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+        self.core.registry.remove(device['id'])
+
+    def set_device_name(self, device, name):
+        self.core.registry.rename(device, name)
+
+    def set_device_state(self, device, state):
+        if device['state'] == state:
+            return False
+        device['state'] = state
+        self.core.device_state_changed(device)
+        return True
+
+    def add_job(self, name, interval, callback, delay=0.0):
+        job = self.core.scheduler.add_job(f"{self.hardware_type()}.{name}", interval, callback, delay)
+        self.jobs.append(job)
+        return job
+
+    def wake_job(self, job, delay=0.0):
+        self.core.scheduler.wake(job, delay)
+
+    async def remove_jobs(self):
+        for job in self.jobs:
+            await self.core.scheduler.remove_job(job)
+        self.jobs = []
+        self.poll_job = None
+
+    def request_stop(self):
+        self.stopped.set()
+
+    async def wait_stopped(self):
+        await self.stopped.wait()
+
+    def mdns_changed(self, name):
+        pass
+
+    async def run_children(self, children, parallelism=None):
+        # runs (device_name, action, delay) entries concurrently
+        slots = asyncio.Semaphore(parallelism) if parallelism else None
+
+        async def run_child(name, action, delay):
+            if delay:
+                await asyncio.sleep(delay)
+
+            device = self.core.get_device_by_name(name)
+            if device is None:
+                self.log("Unknown device_name " + name + " device_action " + action, 'warning')
+                return False
+
+            if slots:
+                async with slots:
+                    return await self.core.run_device_action(device['id'], action)
+            return await self.core.run_device_action(device['id'], action)
+
+        results = await asyncio.gather(*[run_child(*child) for child in children], return_exceptions=True)
+
+        records = []
+        for (name, action, _), result in zip(children, results):
+            if isinstance(result, Exception):
+                self.log_exception(f"child {name} {action}", result)
+            records.append({
+                'device': name, 
+                'action': action, 
+                'status': 'ok' if result and not isinstance(result, Exception) else 'error'
+            })
+        return records
+
+    def complete_children(self, device, label, results):
+        failed = [r['device'] for r in results if r['status'] != 'ok']
+        if len(failed) > 0:
+            self.log(f"{label} [{device['name']}] end, {len(results) - len(failed)}/{len(results)} ok, failed: {', '.join(failed)}", 'warning', device)
+            return ActionResult(False, results)
+
+        self.log(f"{label} [{device['name']}] end")
+        return ActionResult(True, results)
 
     def complete_action(self, device_id, action):
+        # poll right away instead of waiting for the next deadline
+        self.wake_job(self.poll_job)
+
         device = self.get_device(device_id)
         if device['type'] == 'curtain' or device['type'] == 'button':
             return
 
         if action == "enable" or action == "open":
-            device['state'] = 'on'
+            self.set_device_state(device, 'on')
         elif action == "disable" or action == "close":
-            device['state'] = 'off'
+            self.set_device_state(device, 'off')
 
     def get_devices(self):
         return self.devices
@@ -45,24 +162,28 @@ class Hardware:
     async def start(self, configuration):
         self.configuration = configuration
 
+        limit = configuration.get("action_concurrency", self.action_concurrency)
+        self.action_slots = asyncio.Semaphore(limit) if limit else None
+
         self.loop = asyncio.get_event_loop()
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-        self.core.log(f"{type(self).__name__} Started")
+        self.log(f"{type(self).__name__} Started")
         
     async def stop(self):
+        self.core.registry.remove_owner(self)
         self.executor.shutdown()
         self.executor = None
         self.loop = None
-        self.core.log(f"{type(self).__name__} Stopped")
+        self.log(f"{type(self).__name__} Stopped")
 
         
     async def step(self):
-        #self.core.log(f"{type(self).__name__} Step")  
+        #self.log(f"{type(self).__name__} Step")  
         pass
 
     async def run_action(self, device_id, action):
-        #self.core.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
+        #self.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
         return False
 
 #
@@ -71,6 +192,7 @@ class Hardware:
 class DummyHardware(Hardware):
     def __init__(self, core):
         super().__init__(core)
+        self.action_concurrency = None
 
     async def start(self, configuration):
         devices = []
@@ -87,12 +209,12 @@ class DummyHardware(Hardware):
                 'cfg': current
             }
             devices.append(device)
-        self.devices = devices
+        self.set_devices(devices)
 
         await super().start(configuration)
         
     async def run_action(self, device_id, action):
-        self.core.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
+        self.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
         return True
 
 #
@@ -103,6 +225,13 @@ class DummyHardware(Hardware):
 class MultiDeviceHardware(Hardware):
     def __init__(self, core):
         super().__init__(core)
+        # children are limited by their own drivers
+        self.action_concurrency = None
+        self.parallelism = 4
+
+        # child name -> multi devices that contain it
+        self.parents = {}
+        self.refresh_pending = False
 
     async def start(self, configuration):
         devices = []
@@ -120,40 +249,64 @@ class MultiDeviceHardware(Hardware):
                     'cfg': current
                 }
                 devices.append(device)
-                self.devices = devices
             else:
-                self.core.log("invalid children!")
+                self.log("invalid children!", 'error')
+
+        self.parents = {}
+        for device in devices:
+            for current in device['cfg']['children']:
+                self.parents.setdefault(current, []).append(device)
+
+        self.set_devices(devices)
 
+        self.parallelism = configuration.get("parallelism", self.parallelism)
 
         await super().start(configuration)
 
+        # state is derived from the children change events
+        self.core.add_device_listener(self._device_changed)
+        self.refresh_all()
 
-    async def step(self):
+    async def stop(self):
+        self.core.remove_device_listener(self._device_changed)
+        await super().stop()
+
+    def _device_changed(self, device):
+        if device is None:
+            # devices came or went, recompute everything once
+            if not self.refresh_pending:
+                self.refresh_pending = True
+                self.loop.call_soon(self.refresh_all)
+            return
+
+        for name in self.core.registry.get_names(device):
+            for parent in self.parents.get(name, []):
+                self.refresh(parent)
+
+    def refresh(self, device):
+        state = 'on'
+        for current in device['cfg']['children']:
+            children_device = self.core.get_device_by_name(current)
+            if children_device and children_device['state'] != 'on':
+                state = 'off'
+        self.set_device_state(device, state)
+
+    def refresh_all(self):
+        self.refresh_pending = False
         for device in self.get_devices():
-            state = 'on'
-            for current in device['cfg']['children']:
-                children_device = self.core.get_device_by_name(current)
-                if children_device and children_device['state'] != 'on':
-                    state = 'off'
-            device['state'] = state
+            self.refresh(device)
 
         
     async def run_action(self, device_id, action):
         device = self.get_device(device_id)
 
-        self.core.log(f"Multi [{device['name']}] start {action}")
-        
-        children = device['cfg']['children']
-        for current in children:
-            device = self.core.get_device_by_name(current)
-            if device:
-                await self.core.run_device_action(device['id'], action)
-            else:
-                self.core.log("Unknown children name: " + current)
+        self.log(f"Multi [{device['name']}] start {action}")
 
-        self.core.log(f"Multi [{device['name']}] end")
+        parallelism = device['cfg'].get('parallelism', self.parallelism)
+        children = [(current, action, 0) for current in device['cfg']['children']]
+        results = await self.run_children(children, parallelism)
 
-        return True
+        return self.complete_children(device, "Multi", results)
 
 #
 # Button
@@ -162,6 +315,8 @@ class MultiDeviceHardware(Hardware):
 class ButtonHardware(Hardware):
     def __init__(self, core):
         super().__init__(core)
+        self.action_concurrency = None
+        self.parallelism = 4
 
     async def start(self, configuration):
         devices = []
@@ -179,28 +334,31 @@ class ButtonHardware(Hardware):
                     'cfg': current
                 }
                 devices.append(device)
-                self.devices = devices
             else:
-                self.core.log("invalid actions!")
+                self.log("invalid actions!", 'error')
 
+        self.set_devices(devices)
+        self.parallelism = configuration.get("parallelism", self.parallelism)
 
         await super().start(configuration)
         
 
     async def run_action(self, device_id, action):
         device = self.get_device(device_id)
-        self.core.log(f"Button [{device['name']}] start {action}")
-        
-        actions = device['cfg']['actions']
-        for current in actions:
-            device_name = current['device']
-            device_action = current['action']
-            device = self.core.get_device_by_name(device_name)
-            if device:
-                await self.core.run_device_action(device['id'], device_action)
-            else:
-                self.core.log("Unknown device_name " + device_name + " device_action " + device_action)
+        self.log(f"Button [{device['name']}] start {action}")
+
+        parallelism = device['cfg'].get('parallelism', self.parallelism)
+
+        # actions run one after another in the listed order, actions sharing an
+        # explicit stage run together at the place of the first one
+        stages = {}
+        for index, current in enumerate(device['cfg']['actions']):
+            stage = ('stage', current['stage']) if 'stage' in current else ('order', index)
+            child = (current['device'], current['action'], current.get('delay', 0))
+            stages.setdefault(stage, []).append(child)
 
-        self.core.log(f"Button [{device['name']}] end")
+        results = []
+        for children in stages.values():
+            results.extend(await self.run_children(children, parallelism))
 
-        return True
\ No newline at end of file
+        return self.complete_children(device, "Button", results)
@@ -24,7 +24,7 @@ class CommandHardware(Hardware):
                 'cfg': current
             }
             devices.append(device)
-        self.devices = devices
+        self.set_devices(devices)
 
         await super().start(configuration)
 
@@ -39,17 +39,17 @@ class CommandHardware(Hardware):
 
         args = [f"scripts/{script}", cfg_id, action]
 
-        self.core.log("Running command [" + (' | '.join(map(str, args))) + "]")
+        self.log("Running command [" + (' | '.join(map(str, args))) + "]", device=device_id)
 
         try:
             res = subprocess.Popen(args, stdout=subprocess.PIPE)
         except OSError as e:
-            self.core.log("Error [" + str(e) + "]")
+            self.log("Error [" + str(e) + "]", 'error', device_id)
             return -1
 
         res.wait() # wait for process to finish; this also sets the returncode variable inside 'res'
         output = res.stdout.read().decode("utf-8")
 
-        self.core.log("Done with output [" + output + "] return code [" + str(res.returncode) + "]")
+        self.log("Done with output [" + output + "] return code [" + str(res.returncode) + "]", device=device_id)
 
         return res.returncode
@@ -0,0 +1,81 @@
+import time
+
+# polling jobs never sleep less than this, even when a device is overdue
+MIN_DELAY = 0.5
+
+#
+# Device Health
+# - polls fast right after an action or an observed change
+# - decays towards the slow interval while the device stays stable
+# - a device that keeps failing opens the circuit, it is then only probed
+#   with a growing delay until it answers again
+#
+class DeviceHealth:
+    def __init__(self, fast, slow, decay=1.5, failure_threshold=5, probe_interval=30.0, max_probe_interval=600.0):
+        self.fast = fast
+        self.slow = max(slow, fast)
+        self.decay = decay
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+
+        self.interval = fast
+        self.failures = 0
+        self.open = False
+        self.probe_delay = probe_interval
+        self.next_poll = 0.0
+
+    def now(self):
+        return time.monotonic()
+
+    def is_due(self):
+        return self.now() >= self.next_poll
+
+    def is_open(self):
+        return self.open
+
+    def delay(self):
+        return max(self.next_poll - self.now(), 0.0)
+
+    def record_activity(self):
+        # an action was sent, follow the device closely for a while
+        self.interval = self.fast
+        if not self.open:
+            self.next_poll = min(self.next_poll, self.now() + self.fast)
+
+    def record_success(self, changed=False):
+        self.failures = 0
+        self.open = False
+        self.probe_delay = self.probe_interval
+
+        if changed:
+            self.interval = self.fast
+        else:
+            self.interval = min(self.interval * self.decay, self.slow)
+        self.next_poll = self.now() + self.interval
+
+    def record_failure(self):
+        # returns True when this failure opened the circuit
+        self.failures = self.failures + 1
+
+        if self.open:
+            # a failed probe, wait longer for the next one
+            self.probe_delay = min(self.probe_delay * 2, self.max_probe_interval)
+            self.next_poll = self.now() + self.probe_delay
+            return False
+
+        if self.failures >= self.failure_threshold:
+            self.open = True
+            self.next_poll = self.now() + self.probe_delay
+            return True
+
+        self.next_poll = self.now() + self.fast
+        return False
+
+
+def next_delay(delays, default=None):
+    # the delay of a polling job is the one of its most urgent device
+    delays = list(delays)
+    if not delays:
+        return default
+    return max(min(delays), MIN_DELAY)
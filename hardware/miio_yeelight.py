@@ -1,9 +1,9 @@
 
 from hardware.base import Hardware
+from hardware.health import DeviceHealth, next_delay
 from miio.integrations.yeelight import Yeelight
 from miio.protocol import Message
 
-import datetime
 import logging
 import codecs
 import logging
@@ -14,14 +14,24 @@ class MiioYeelightHardware(Hardware):
     def __init__(self, core):
         super().__init__(core)
 
-        self.last_refresh = None
+        # lamps are polled every refresh_interval after a change, slower when stable
         self.refresh_interval = 5
-
-        self.last_discover = None
+        self.slow_refresh_interval = 60
         self.discover_interval = 30
 
+        self.discover_job = None
+
+        # ids seen by live discovery, cached ips are only trusted until then
+        self.confirmed = set()
+
     async def start(self, configuration):
         #logging.basicConfig(level=logging.DEBUG)
+        if "refresh_interval" in configuration:
+            self.refresh_interval = configuration["refresh_interval"]
+
+        if "slow_refresh_interval" in configuration:
+            self.slow_refresh_interval = configuration["slow_refresh_interval"]
+
         devices = []
         counter = 0
         for current in configuration["devices"]:
@@ -33,12 +43,26 @@ class MiioYeelightHardware(Hardware):
                 'state': 'off',
 
                 'cfg': current,
-                'hardware': None 
+                'hardware': None,
+                'health': DeviceHealth(self.refresh_interval, self.slow_refresh_interval)
             }
             devices.append(device)
-        self.devices = devices
+        self.set_devices(devices)
         await super().start(configuration)
 
+        # lamps found on a previous run are usable right away
+        cached = {}
+        for current in devices:
+            record = self.core.discovery_cache.get('yeelight', current['cfg']['id'])
+            if record:
+                cached[current['cfg']['id']] = record['ip']
+        if cached:
+            self.log(f"Yeelight cached ips: {cached}")
+            await self.loop.run_in_executor(self.executor, self._sync_apply_discover, cached)
+
+        self.discover_job = self.add_job("discover", self.discover_interval, self.discover)
+        self.poll_job = self.add_job("refresh", self.refresh_interval, self.step)
+
     def _sync_discover(self):
         timeout = 1
         addr = "<broadcast>"
@@ -57,34 +81,27 @@ class MiioYeelightHardware(Hardware):
             try:
                 data, recv_addr = s.recvfrom(1024)
                 m = Message.parse(data)  # type: Message
-                #self.core.log(f"Got a response: {m}")
+                #self.log(f"Got a response: {m}")
 
                 if recv_addr[0] not in seen_addrs:
                     ip = recv_addr[0]
                     id = binascii.hexlify(m.header.value.device_id).decode()
                     token = codecs.encode(m.checksum, "hex")
 
-                    #self.core.log(f"Yeelight IP: {ip} ID: {id} token: {token}")
+                    #self.log(f"Yeelight IP: {ip} ID: {id} token: {token}")
                     seen_addrs.append(recv_addr[0])
 
                     devices[id] = ip
             except socket.timeout:
                 break
             except Exception as ex:
-                self.core.log_exception("error while reading discover results", ex)
+                self.log_exception("error while reading discover results", ex)
                 break
         s.close()
 
         return devices
 
-    def _sync_refresh(self):
-        discovered = {}
-
-        if self.elapsed(self.last_discover, self.discover_interval):
-            discovered = self._sync_discover()
-            #self.core.log(f"Yeelight Discovered {discovered}")
-            self.last_discover = datetime.datetime.now()
-
+    def _sync_apply_discover(self, discovered):
         all_discovered = True
 
         for current in self.devices:
@@ -94,36 +111,33 @@ class MiioYeelightHardware(Hardware):
             if id in discovered:
                 if current['hardware'] != None and discovered[id] != current['hardware'].ip:
                     current['hardware'] = None
-                    self.core.log(f"Yeelight {id} ip changed to {discovered[id]}")
+                    self.log(f"Yeelight {id} ip changed to {discovered[id]}")
 
                 if current['hardware'] == None:
                     try:
                         current['hardware'] = Yeelight(discovered[id], token)
-                        self.core.log(f"Yeelight {id} created ip: {discovered[id]}")
+                        self.log(f"Yeelight {id} created ip: {discovered[id]}")
                     except Exception as exception:
                         current['hardware'] = None
-                        self.core.log(f"Failed to create Yeelight {id} on ip: {discovered[id]}")
-                        #self.core.log_exception('failed to create yeelight', exception)
-                        return False
+                        self.log(f"Failed to create Yeelight {id} on ip: {discovered[id]}", 'warning', current)
+                        #self.log_exception('failed to create yeelight', exception)
     
             if current['hardware'] == None:
                 all_discovered = False
-                continue
 
+        return all_discovered
+
+    def _sync_refresh(self, devices):
+        results = []
+        for current in devices:
             try:
                 status = current['hardware'].status()
-
-                value = "on" if status.is_on else "off"
-                if current['state'] != value:
-                    current['state'] = value
-                    self.core.log("Yeelight [" +  current['name'] + "] value: " + current['state'])
-
+                results.append((current, "on" if status.is_on else "off"))
             except Exception as exception:
-                self.core.log(f"Unable to communicate with device {current['name']}")
-                return False
+                self.log_exception(f"Failed to refresh [{current['name']}]", exception, current)
+                results.append((current, None))
 
-        
-        self.discover_interval = 10 * 60 if all_discovered else 30
+        return results
 
     def _sync_action(self, hardware, action):
         try:
@@ -137,30 +151,65 @@ class MiioYeelightHardware(Hardware):
             return (result != None) and (len(result) == 1) and (result[0] == 'ok')
 
         except Exception as exception:
-            self.core.log_exception('_sync_action', exception)
+            self.log_exception('_sync_action', exception)
             return False
 
     async def run_action(self, device_id, action):
         device = self.get_device(device_id)
-        self.core.log(f"Yeelight [{device['name']}] start {action}")
+        self.log(f"Yeelight [{device['name']}] start {action}")
 
         hardware = device['hardware']
 
         if hardware == None:
-            self.core.log(f"Hardware {device_id} not ready for action {action}")
+            self.log(f"Hardware {device_id} not ready for action {action}", 'warning', device_id)
             return False
         
         result = await self.loop.run_in_executor(self.executor, self._sync_action, hardware, action)
+        if result:
+            device['health'].record_activity()
 
-        self.core.log(f"Yeelight [{device['name']}] end")
+        self.log(f"Yeelight [{device['name']}] end")
 
         return result
 
         
+    async def discover(self):
+        discovered = await self.loop.run_in_executor(self.executor, self._sync_discover)
+        #self.log(f"Yeelight Discovered {discovered}")
+        for id, ip in discovered.items():
+            self.core.discovery_cache.put('yeelight', id, ip=ip)
+        self.confirmed.update(discovered.keys())
+
+        all_discovered = await self.loop.run_in_executor(self.executor, self._sync_apply_discover, discovered)
+        all_discovered = all_discovered and all(d['cfg']['id'] in self.confirmed for d in self.devices)
+        self.wake_job(self.poll_job)
+
+        # slow down once every device is known
+        return 10 * 60 if all_discovered else self.discover_interval
+
     async def step(self):
         await super().step()
 
-        if self.elapsed(self.last_refresh, self.refresh_interval):
-            await self.loop.run_in_executor(self.executor, self._sync_refresh)
-            self.last_refresh = datetime.datetime.now()
+        # unreachable lamps are left alone until their next probe
+        devices = [d for d in self.devices if d['hardware'] != None and d['health'].is_due()]
+        if devices:
+            results = await self.loop.run_in_executor(self.executor, self._sync_refresh, devices)
+
+            for current, value in results:
+                health = current['health']
+                if value is None:
+                    self.log(f"Unable to communicate with device {current['name']}", 'warning', current)
+                    self.core.scheduler.metric_errors.inc(self.poll_job.name)
+                    if health.record_failure():
+                        self.log(f"Yeelight [{current['name']}] keeps failing, probing it every {health.probe_delay}s", 'warning', current)
+                    continue
+
+                changed = self.set_device_state(current, value)
+                if changed:
+                    self.log("Yeelight [" +  current['name'] + "] value: " + value, device=current)
+                health.record_success(changed)
+                self.core.discovery_cache.touch('yeelight', current['cfg']['id'])
+
+        # sleep until the next lamp is due
+        return next_delay((d['health'].delay() for d in self.devices if d['hardware'] != None), self.refresh_interval)
             
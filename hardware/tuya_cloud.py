@@ -1,14 +1,23 @@
 import datetime
 import logging
 import asyncio
+import concurrent.futures
+import json
+import os
+import pathlib
+import time
+import types
 
 from hardware.base import Hardware
 from tuya_iot import (
     TuyaOpenAPI,
     TuyaOpenMQ,
     TuyaDeviceManager,
+    TuyaDeviceListener,
+    TuyaTokenInfo,
     TUYA_LOGGER
 )
+from tuya_iot.openapi import TO_C_SMART_HOME_REFRESH_TOKEN_API
 
 class LogHandler(logging.Handler):
     def __init__(self, core):
@@ -17,7 +26,51 @@ class LogHandler(logging.Handler):
 
     def emit(self, record):
         msg = self.format(record)
-        self.core.log(msg)
+        level = record.levelname.lower()
+        if level not in ('debug', 'info', 'warning'):
+            level = 'error'
+        self.core.log(msg, level, 'TuyaCloudHardware')
+
+#
+# Cloud OpenAPI
+# - the sdk logs in again by itself when a token is rejected (code 1010), with
+#   the credentials connect() keeps in private fields, a restored session
+#   never calls connect() so they are set here
+# - written against tuya-iot-py-sdk 0.6.6, set_credentials returns False when
+#   a newer sdk renamed the fields and the caller then does a full connect()
+#
+class CloudOpenAPI(TuyaOpenAPI):
+    CREDENTIALS = ('_TuyaOpenAPI__username', '_TuyaOpenAPI__password', '_TuyaOpenAPI__country_code', '_TuyaOpenAPI__schema')
+
+    def set_credentials(self, username, password, country_code, schema):
+        if not all(hasattr(self, name) for name in self.CREDENTIALS):
+            return False
+
+        for name, value in zip(self.CREDENTIALS, (username, password, country_code, schema)):
+            setattr(self, name, value)
+        return True
+
+#
+# Device Listener
+# - called from the mq thread, hands a copy of the change over to the loop
+#
+class DeviceListener(TuyaDeviceListener):
+    def __init__(self, hardware):
+        self.hardware = hardware
+
+    def _call(self, callback, *args):
+        loop = self.hardware.loop
+        if loop and not loop.is_closed():
+            loop.call_soon_threadsafe(callback, *args)
+
+    def update_device(self, device):
+        self._call(self.hardware._device_updated, device.id, dict(device.status))
+
+    def add_device(self, device):
+        self._call(self.hardware._device_added, device.id)
+
+    def remove_device(self, device_id):
+        self._call(self.hardware._device_removed, device_id)
 
 class TuyaCloudHardware(Hardware):
     def __init__(self, core):
@@ -28,114 +81,258 @@ class TuyaCloudHardware(Hardware):
         self.lastUpdate = None
         self.updateInterval = 5 * 60
 
+        # with mq pushes the full refresh only reconciles missed changes
+        self.reconcileInterval = 30 * 60
+        self.refresh_job = None
+
+        # tuyaId|status -> device, and the last synced values per tuyaId
+        self.entries = {}
+        self.snapshots = {}
+
+        # status reads are split in chunks (20 ids is the api limit) and run on their own pool
+        self.refresh_chunk = 20
+        self.refresh_concurrency = 4
+        self.refresh_executor = None
+
+        # the session token and device catalogue survive restarts
+        self.cache_path = pathlib.Path(__file__).parent.parent / 'tuya_cloud_cache.json'
+        self.cached_token = None
+        self.cached_ids = set()
+        self.cache_saved = None
+
         # TUYA_LOGGER.setLevel(logging.DEBUG)
         TUYA_LOGGER.setLevel(logging.INFO)
-        TUYA_LOGGER.addHandler(LogHandler(self.core))
 
-    def _sync_device_map(self):
-        for tuyaId in self.deviceManager.device_map.keys():
-            tuyaDevice = self.deviceManager.device_map.get(tuyaId)
-
-            for status in tuyaDevice.status.keys():
-                type = None
-                if status == "switch_1" or status == "switch_2":
-                    type = "switch"
-                elif status == "switch_led":
-                    type = "light"
-                elif status == "control" and tuyaDevice.product_name == 'Curtain switch':
-                    type = "curtain"
-                #else:
-                #    self.core.log(tuyaDevice.product_name + " > Unknown status: " + status);
-                
-                if type is None:
-                    continue
-
-
-                id = self.hardware_type() + "|" + tuyaId + "|" + status
-                device = self.get_device(id)
-                if device is None:
-                    device = {
-                        'id': id,
-                        'type': type,
-                        'state': 'off'
-                    }
-                    self.devices.append(device)
-                
-                # update data
-                device['name'] = tuyaDevice.name
-                if tuyaDevice.product_name.startswith('2G'):
-                    device['name'] += " " + status[-1]
+        # removed on stop, a reload would otherwise repeat every sdk line
+        self.log_handler = LogHandler(self.core)
+        TUYA_LOGGER.addHandler(self.log_handler)
+
+    def _device_type(self, tuyaDevice, status):
+        if status == "switch_1" or status == "switch_2":
+            return "switch"
+        elif status == "switch_led":
+            return "light"
+        elif status == "control" and tuyaDevice.product_name == 'Curtain switch':
+            return "curtain"
+        #else:
+        #    self.log(tuyaDevice.product_name + " > Unknown status: " + status);
+        return None
+
+    def _device_name(self, tuyaDevice, status):
+        name = tuyaDevice.name
+        if tuyaDevice.product_name.startswith('2G'):
+            name += " " + status[-1]
+        return name
+
+    def _sync_device_entries(self, tuyaId, tuyaDevice):
+        # creates or renames the entries, only when the device is new or renamed
+        for status in tuyaDevice.status.keys():
+            type = self._device_type(tuyaDevice, status)
+            if type is None:
+                continue
+
+            name = self._device_name(tuyaDevice, status)
+
+            key = tuyaId + "|" + status
+            device = self.entries.get(key)
+            if device is None:
+                device = {
+                    'id': self.hardware_type() + "|" + key,
+                    'name': name,
+                    'type': type,
+                    'state': 'off'
+                }
+                self.entries[key] = device
+                self.add_device(device)
+            else:
+                self.set_device_name(device, name)
+
+    def _apply_status(self, tuyaId, status, label):
+        # only the statuses that changed since the last sync are applied
+        snapshot = self.snapshots.get(tuyaId)
+        if snapshot is None:
+            return
+
+        previous = snapshot['status']
+        for code, value in status.items():
+            if code in previous and previous[code] == value:
+                continue
+            previous[code] = value
+
+            device = self.entries.get(tuyaId + "|" + code)
+            if device is None:
+                continue
 
-                value = "on" if str(tuyaDevice.status[status]) == "True" else "off"
-                if device['state'] != value:
-                    device['state'] = value
-                    self.core.log("Updated [" +  device['name'] + "] value: " + device['state'])
+            value = "on" if str(value) == "True" else "off"
+            if self.set_device_state(device, value):
+                self.log(label + " [" +  device['name'] + "] value: " + device['state'], device=device)
+
+    def _sync_device_map(self):
+        # the mq thread may add devices meanwhile, work on a copy
+        for tuyaId, tuyaDevice in list(self.deviceManager.device_map.items()):
+            snapshot = self.snapshots.get(tuyaId)
+            if snapshot is None or snapshot['name'] != tuyaDevice.name or snapshot['product_name'] != tuyaDevice.product_name:
+                self._sync_device_entries(tuyaId, tuyaDevice)
+                self.snapshots[tuyaId] = {
+                    'name': tuyaDevice.name,
+                    'product_name': tuyaDevice.product_name,
+                    'status': {}
+                }
+
+            self._apply_status(tuyaId, dict(tuyaDevice.status), "Updated")
+
+        # cached devices missing from the first full list are gone from the account
+        if self.cached_ids and len(self.deviceManager.device_map) > 0:
+            for tuyaId in self.cached_ids - set(self.deviceManager.device_map.keys()):
+                self._device_removed(tuyaId)
+            self.cached_ids = set()
+
+    def _device_updated(self, tuyaId, status):
+        # only the entries of the reporting device are touched
+        self._apply_status(tuyaId, status, "Pushed")
+
+    def _device_added(self, tuyaId):
+        self.log(f"Tuya device {tuyaId} added")
+        self.wake_job(self.refresh_job)
+
+    def _device_removed(self, tuyaId):
+        snapshot = self.snapshots.pop(tuyaId, None)
+        if snapshot is None:
+            return
+
+        for status in snapshot['status'].keys():
+            device = self.entries.pop(tuyaId + "|" + status, None)
+            if device:
+                self.log(f"Tuya device [{device['name']}] removed", device=device)
+                self.remove_device(device)
+
+    def is_mq_alive(self):
+        return self.openmq is not None and self.openmq.is_alive()
 
     def _sync_refresh(self): 
+        # returns the ids whose status still needs to be read
         try:
+            # a restored session may be rejected, then a full login follows
+            for attempt in range(2):
+                if self.openapi == None:
+                    self._sync_open()
 
-            if self.openapi == None:
-                self._sync_open()
+                if self.openapi == None:
+                    return []
 
-            if self.openapi == None:
-                return
+                ids = list(self.deviceManager.device_map.keys())
 
-            ids = []
-            for device_id in self.deviceManager.device_map.keys():
-                ids.append(device_id)
+                if len(ids) == 0:
+                    # the device list comes with the statuses
+                    self.deviceManager.update_device_list_in_smart_home()
 
-            if len(ids) == 0:
-                self.deviceManager.update_device_list_in_smart_home()
-            else:
-                self.deviceManager._update_device_list_status_cache(ids)
+                    # a token the sdk replaced during the call, list again with the new one
+                    if attempt == 0 and self.openapi.is_connect() and len(self.deviceManager.device_map) == 0:
+                        continue
+
+                if self.openapi.is_connect():
+                    # started once the token is known to be valid (and renewed),
+                    # pushes only apply to devices already listed anyway
+                    if self.openmq.ident is None:
+                        self.openmq.start()
+                    return ids
+
+                self.log("Tuya session expired, logging in again", 'warning')
+                self._sync_close()
                 
         except Exception as exception:
-            self.core.log_exception('_sync_refresh', exception)
+            self.log_exception('_sync_refresh', exception)
 
-        self._sync_device_map()
-        self.lastUpdate = datetime.datetime.now()
+        return []
+
+    def _sync_refresh_status(self, ids):
+        try:
+            self.deviceManager._update_device_list_status_cache(ids)
+        except Exception as exception:
+            self.log_exception('_sync_refresh_status', exception)
+
+    async def refresh_status(self, ids):
+        chunks = [ids[i:i + self.refresh_chunk] for i in range(0, len(ids), self.refresh_chunk)]
+        if len(chunks) == 0:
+            return
+
+        # the first chunk renews the access token when needed, the others then share it
+        await self.loop.run_in_executor(self.refresh_executor, self._sync_refresh_status, chunks[0])
+        await asyncio.gather(
+            *[self.loop.run_in_executor(self.refresh_executor, self._sync_refresh_status, chunk) for chunk in chunks[1:]])
 
     def _sync_open(self): 
-        self.core.log("Tuya trying to connect...")
+        self.log("Tuya trying to connect...")
         self._sync_close()
 
         configuration = self.configuration
 
-        self.openapi = TuyaOpenAPI(configuration['endpoint'], configuration['access_id'], configuration['access_key'])
+        self.openapi = CloudOpenAPI(configuration['endpoint'], configuration['access_id'], configuration['access_key'])
         self.openapi.set_dev_channel("hass")
-        self.openapi.connect(configuration['username'], configuration['password'], configuration['country_code'], configuration['schema'])
+
+        # a saved session is only used when the sdk can log in again by itself
+        token, self.cached_token = self.cached_token, None
+        if token and token.get('refresh_token') and \
+                self.openapi.set_credentials(configuration['username'], configuration['password'], configuration['country_code'], configuration['schema']):
+            self._sync_restore_session(token)
+
+        if not self.openapi.is_connect():
+            self.openapi.connect(configuration['username'], configuration['password'], configuration['country_code'], configuration['schema'])
 
         if self.openapi.is_connect():
             self.openmq = TuyaOpenMQ(self.openapi)
-            # self.openmq.start()
+            # the mq thread sleeps for hours between reconnects, it must not hold the process
+            self.openmq.daemon = True
 
             self.deviceManager = TuyaDeviceManager(self.openapi, self.openmq)
-            self.core.log("Tuya connected")
+            self.deviceManager.add_device_listener(DeviceListener(self))
+            self.log("Tuya connected")
         else:
-            self.core.log("Tuya failed to connect")
+            self.log("Tuya failed to connect", 'warning')
             self._sync_close()
 
 
+    def _sync_restore_session(self, token):
+        # a saved token that is still valid needs no round trip at all
+        if token['expire_time'] - 60 * 1000 > int(time.time() * 1000):
+            info = TuyaTokenInfo({})
+            info.access_token = token['access_token']
+            info.refresh_token = token['refresh_token']
+            info.uid = token['uid']
+            info.platform_url = token.get('platform_url', "")
+            info.expire_time = token['expire_time']
+            self.openapi.token_info = info
+            self.log("Tuya session restored")
+            return
+
+        # an expired one is renewed before any device call, a refresh instead of a login
+        response = self.openapi.get(TO_C_SMART_HOME_REFRESH_TOKEN_API + token['refresh_token'])
+        if response and response.get("success"):
+            self.openapi.token_info = TuyaTokenInfo(response)
+            self.log("Tuya session renewed")
+        elif not self.openapi.is_connect():
+            self.log("Tuya saved session rejected", 'warning')
+
     def _sync_close(self):
         if self.deviceManager:
             self.deviceManager.device_listeners.clear()
             self.deviceManager.device_map.clear()
             self.deviceManager = None
 
-        if self.openmq and self.openmq.is_alive():
+        if self.openmq and self.openmq.is_alive() and self.openmq.client:
+            # not joined, the thread only wakes up when its mq config expires
             self.openmq.client.loop_stop()
             self.openmq.stop()
-            self.openmq.join()
 
         self.openmq = None
 
         self.openapi = None
 
     def _sync_update_status(self, device, device_id, status, value):
-        self.core.log(f"{type(self).__name__} run_axction device_id={device_id} status={status} value={value}")
+        self.log(f"{type(self).__name__} run_axction device_id={device_id} status={status} value={value}")
 
         if device is None:
-            self.core.log("Empty device")
+            self.log("Empty device", 'warning', device_id)
             return 0
 
         if device['type'] != 'curtain':
@@ -150,25 +347,131 @@ class TuyaCloudHardware(Hardware):
                 if response["success"]:
                     return True
                 else:
-                    self.core.log(response)
+                    self.log(response, 'warning', device)
 
         except Exception as exception:
-            self.core.log_exception('_sync_update_status', exception)
+            self.log_exception('_sync_update_status', exception)
             
         return False
         
+    def load_cache(self):
+        try:
+            with open(self.cache_path, "r") as file:
+                cache = json.loads(file.read())
+        except FileNotFoundError:
+            return
+        except Exception as exception:
+            self.log_exception('load_cache', exception)
+            return
+
+        # only for the same account
+        if cache.get('account') != self._cache_account():
+            return
+
+        self.cached_token = cache.get('token')
+        self.cached_ids = set(cache.get('devices', {}).keys())
+
+        for tuyaId, record in cache.get('devices', {}).items():
+            tuyaDevice = types.SimpleNamespace(**record)
+            self._sync_device_entries(tuyaId, tuyaDevice)
+            self.snapshots[tuyaId] = {
+                'name': tuyaDevice.name,
+                'product_name': tuyaDevice.product_name,
+                'status': {}
+            }
+            self._apply_status(tuyaId, tuyaDevice.status, "Cached")
+
+        self.log(f"Tuya {len(self.snapshots)} devices loaded from cache")
+
+    def _cache_account(self):
+        return [self.configuration['endpoint'], self.configuration['access_id'], self.configuration['username']]
+
+    def _sync_write_cache(self, text):
+        # the file holds a session token, keep it private
+        temporary = str(self.cache_path) + ".tmp"
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as file:
+            file.write(text)
+        os.replace(temporary, self.cache_path)
+
+    async def save_cache(self):
+        token = None
+        if self.openapi and self.openapi.is_connect():
+            info = self.openapi.token_info
+            token = {
+                'access_token': info.access_token,
+                'refresh_token': info.refresh_token,
+                'uid': info.uid,
+                'platform_url': info.platform_url,
+                'expire_time': info.expire_time
+            }
+
+        devices = {}
+        for tuyaId, snapshot in self.snapshots.items():
+            devices[tuyaId] = {
+                'name': snapshot['name'],
+                'product_name': snapshot['product_name'],
+                'status': snapshot['status']
+            }
+
+        text = json.dumps({'account': self._cache_account(), 'token': token, 'devices': devices}, indent=4)
+        if text == self.cache_saved:
+            return
+
+        try:
+            await self.loop.run_in_executor(self.executor, self._sync_write_cache, text)
+            self.cache_saved = text
+        except Exception as exception:
+            self.log_exception('save_cache', exception)
+
     async def stop(self):
+        await self.save_cache()
         await self.loop.run_in_executor(self.executor, self._sync_close)
+        self.refresh_executor.shutdown()
+        self.refresh_executor = None
+        TUYA_LOGGER.removeHandler(self.log_handler)
         await super().stop()
 
+    async def start(self, configuration):
+        await super().start(configuration)
+
+        if "refresh_interval" in configuration:
+            self.updateInterval = configuration["refresh_interval"]
+
+        if "reconcile_interval" in configuration:
+            self.reconcileInterval = configuration["reconcile_interval"]
+
+        if "refresh_concurrency" in configuration:
+            self.refresh_concurrency = configuration["refresh_concurrency"]
+
+        self.refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.refresh_concurrency)
+
+        if "cache_file" in configuration:
+            self.cache_path = pathlib.Path(__file__).parent.parent / configuration["cache_file"]
+
+        # cached devices show up right away, the session and device list are refreshed by the job
+        self.load_cache()
+
+        self.refresh_job = self.add_job("refresh", self.updateInterval, self.step)
+
     async def step(self):
         await super().step()
 
-        if self.elapsed(self.lastUpdate, self.updateInterval):
-            await self.loop.run_in_executor(self.executor, self._sync_refresh)
+        ids = await self.loop.run_in_executor(self.executor, self._sync_refresh)
+        if self.deviceManager:
+            await self.refresh_status(ids)
+        self.lastUpdate = datetime.datetime.now()
+
+        # registry updates happen on the loop
+        if self.deviceManager:
+            self._sync_device_map()
+            await self.save_cache()
+
+        # pushed changes keep the state current, polling is only a fallback
+        return self.reconcileInterval if self.is_mq_alive() else self.updateInterval
 
     async def run_action(self, device_id, action):
-        # self.core.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
+        # self.log(f"{type(self).__name__} run_action device_id={device_id} action={action}")
         device_id_parts = device_id.split('|')
         device = self.get_device(device_id)
         return await self.loop.run_in_executor(self.executor, self._sync_update_status, device, device_id_parts[1], device_id_parts[2], action)
@@ -1,32 +1,60 @@
 
 from hardware.base import Hardware
+from hardware.health import DeviceHealth, next_delay
 from hardware.tuya_local_api import TuyaDiscovery
 from hardware.tuya_local_api import Device
+from hardware.tuya_local_api import error_json
 
 import datetime
 import asyncio
 import re
+import time
 
 class TuyaLocalHardware(Hardware):
     def __init__(self, core):
         super().__init__(core)
         self.discover = TuyaDiscovery()
 
-        self.status_iterator = 0
-        self.status_batch = 5
+        # status requests run concurrently, each bounded by its own timeout
+        self.refresh_concurrency = 5
+        self.refresh_timeout = 10.0
+        self.refresh_slots = None
+        self.refresh_tasks = {}
 
+        # polls speed up to refresh_interval after a change and slow down when stable
         self.refresh_interval = 1.0
+        self.slow_refresh_interval = 30.0
+
+        # devices with an open socket push their changes, polling is only a fallback
+        self.connected_refresh_interval = 60.0
+        self.heartbeat_interval = 10.0
+
+        # one protocol session per physical device, shared by all its dps
+        self.sessions = {}
 
     async def start(self, configuration):
         await super().start(configuration)
-        await self.discover.start(self.loop)
 
-        if "refresh_batch" in configuration:
-            self.status_batch = configuration["refresh_batch"]
+        # refresh_batch is the older name of the setting
+        self.refresh_concurrency = configuration.get("refresh_concurrency", 
+            configuration.get("refresh_batch", self.refresh_concurrency))
+        self.refresh_slots = asyncio.Semaphore(self.refresh_concurrency)
+
+        if "refresh_timeout" in configuration:
+            self.refresh_timeout = configuration["refresh_timeout"]
 
         if "refresh_interval" in configuration:
             self.refresh_interval = configuration["refresh_interval"]
 
+        if "slow_refresh_interval" in configuration:
+            self.slow_refresh_interval = configuration["slow_refresh_interval"]
+
+        if "connected_refresh_interval" in configuration:
+            self.connected_refresh_interval = configuration["connected_refresh_interval"]
+
+        if "heartbeat_interval" in configuration:
+            self.heartbeat_interval = configuration["heartbeat_interval"]
+
         devices = []
         id_counter = 0
         for current in configuration["devices"]:
@@ -48,8 +76,9 @@ class TuyaLocalHardware(Hardware):
                 if device_count > 1:
                     name = f"{name} {dp}"
 
-                hardware = Device(current['id'], "", current['token'])
-                hardware.logger = self.core.log
+                session = self.sessions.get(current['id'])
+                if session is None:
+                    session = self.create_session(current)
 
                 device = {
                     'id': self.hardware_type() + "_" + str(id_counter),
@@ -57,32 +86,84 @@ class TuyaLocalHardware(Hardware):
                     'type': type,
                     'state': 'off',
 
-                    'last_status': None,
-                    'errors': 0,
-                    'hardware': hardware, 
+                    'hardware': session['hardware'], 
                     'dp': dp,
                     'cfg': current
                 }
+                session['devices'].append(device)
                 devices.append(device)
 
-        if len(devices) < self.status_batch:
-            self.status_batch = len(devices)
+        self.set_devices(devices)
 
-        self.devices = devices
+        self.discover.on_discovered = self._device_discovered
+        self.discover.on_seen = self._device_seen
+        await self.discover.start(self.loop)
+
+        self.poll_job = self.add_job("poll", self.refresh_interval, self.step)
+        self.add_job("heartbeat", self.heartbeat_interval, self.keep_alive, self.heartbeat_interval)
+
+    def create_session(self, cfg):
+        # the last known ip lets the device work before it broadcasts again
+        address = ""
+        cached = self.core.discovery_cache.get('tuya', cfg['id'])
+        if cached:
+            address = cached['ip']
+            self.log(f"Tuya [{cfg['name']}] cached ip: {address}")
+
+        hardware = Device(cfg['id'], address, cfg['token'])
+        hardware.logger = self.log
+        hardware.connection.logger = self.log
+        hardware.on_status = self._status_pushed
+
+        session = {
+            'id': cfg['id'],
+            'name': cfg['name'],
+            'hardware': hardware,
+            'devices': [],
+            'last_status': None,
+            'health': DeviceHealth(self.refresh_interval, self.slow_refresh_interval)
+        }
+        self.sessions[cfg['id']] = session
+        return session
+
+    def _device_discovered(self, hardware_id, record):
+        session = self.sessions.get(hardware_id)
+        if session is None or 'ip' not in record:
+            return
+
+        ip = record['ip']
+        self.core.discovery_cache.put('tuya', hardware_id, ip=ip)
+
+        if session['hardware'].address != ip:
+            session['hardware'].address = ip
+            self.log(f"Tuya [{session['name']}] ip: {ip}")
+
+            # pick up the new ip right away
+            self.wake_job(self.poll_job)
+
+    def _device_seen(self, hardware_id):
+        self.core.discovery_cache.touch('tuya', hardware_id)
+
+    def _status_pushed(self, hardware_id, status):
+        self.apply_status(hardware_id, status, partial=True)
 
     async def stop(self):
         self.discover.close()
+        for task in list(self.refresh_tasks.values()):
+            task.cancel()
+        for session in self.sessions.values():
+            session['hardware'].close()
         await super().stop()
 
     async def run_action(self, device_id, action):
         device = self.get_device(device_id)
 
-        self.core.log(f"Tuya [{device['name']}] start {action}")
+        self.log(f"Tuya [{device['name']}] start {action}")
 
         hardware = device['hardware']
 
         if hardware.address == "":
-            self.core.log(f"Hardware {device_id} not ready for action {action}")
+            self.log(f"Hardware {device_id} not ready for action {action}", 'warning', device_id)
             return False
         
         dp = device["dp"]
@@ -95,42 +176,41 @@ class TuyaLocalHardware(Hardware):
         else:
             action = (action == 'enable') or (action == 'open')
         
-        attempts = 5
-        while attempts > 0:
-            self.core.log(f"Tuya [{device['name']}] set_status({action},{dp}) | attempt {attempts}")  
-            result = await hardware.set_status(action, dp)     
-            
-            if (result is not None and 
-                'error' in result and 
-                result['error'] == 'device already in use'):
-                attempts = attempts - 1 
-                await asyncio.sleep(3.5)
-            else:
-                attempts = 0
+        # the session serializes this with the polls of every dp on the device
+        self.log(f"Tuya [{device['name']}] set_status({action},{dp})")  
+        result = await hardware.set_status(action, dp)     
             
         if result is not None and 'error' not in result:
-            self.core.log(f"Tuya [{device['name']}] end") 
+            self.sessions[device['cfg']['id']]['health'].record_activity()
+            self.log(f"Tuya [{device['name']}] end") 
             return True
 
-        self.core.log(f"Action Error [{device['name']}] {result}")
+        self.log(f"Action Error [{device['name']}] {result}", 'warning', device)
 
         return False    
 
-    def apply_status(self, hardware_id, status):
-        # self.core.log(f"Status {device['name']} : {status}");
-        for device in self.get_devices():
-            if device['cfg']['id'] != hardware_id:
-                continue
-            
-            device['last_status'] = datetime.datetime.now()
-
-            if status is None or 'error' in status:
-                device['errors'] = device['errors'] + 1;
-                self.core.log(f"Failed to call status [{device['name']}] : {status}")
-                continue
-
+    def apply_status(self, hardware_id, status, partial=False):
+        # self.log(f"Status {session['name']} : {status}");
+        session = self.sessions.get(hardware_id)
+        if session is None:
+            return
+
+        health = session['health']
+        if status is None or 'error' in status:
+            session['last_status'] = datetime.datetime.now()
+            self.log(f"Failed to call status [{session['name']}] : {status}", 'warning')
+            if health.record_failure():
+                self.log(f"Too many errors for [{session['name']}] status. probing it every {health.probe_delay}s", 'warning')
+                session['hardware'].close()
+            return
+
+        if not partial:
+            session['last_status'] = datetime.datetime.now()
+
+        # one response updates every dp of the device
+        changed = False
+        for device in session['devices']:
             dp = str(device["dp"])
-            ok = False
 
             if 'dps' in status and dp in status['dps']:
                 value = "on" if status['dps'][dp] else "off"
@@ -138,61 +218,97 @@ class TuyaLocalHardware(Hardware):
                 if device['type'] == "curtain":
                     value = "off"
 
-                if device['state'] != value:
-                    device['state'] = value
-                    self.core.log("Tuya [" +  device['name'] + "] value: " + device['state'])
+                if self.set_device_state(device, value):
+                    self.log("Tuya [" +  device['name'] + "] value: " + device['state'], device=device)
+                    changed = True
 
-                ok = True
+            # pushed updates only carry the dps that changed
+            elif not partial:
+                self.log(f"Failed to apply status [{device['name']}]\n{status}", 'warning', device)
 
-            #self.core.log(f"updated [{device['name']}] status!")
-
-            if not ok:
-                self.core.log(f"Failed to apply status [{device['name']}]\n{status}")
+        if not partial:
+            health.record_success(changed)
+            self.core.discovery_cache.touch('tuya', hardware_id)
 
     async def step(self):
         await super().step()
 
-        devices = self.get_devices()
-        device_count = len(devices)
-        if device_count <= 0:
-            return 
-
-        # find out the devices ip
-        for key in self.discover.devices:
-            for device in devices:
-                if device['cfg']['id'] != key:
-                    continue
-
-                ip = self.discover.devices[key]['ip']
-                if device['hardware'].address != ip:
-                    device['hardware'].address = ip
-                    self.core.log(f"Tuya [{device['name']}] ip: {ip}")
-
-        # get the device status
-        end = self.status_iterator + self.status_batch
-        while self.status_iterator < end:
-            index = self.status_iterator % device_count
-            device = devices[index]
-            self.status_iterator = self.status_iterator + 1
-
-            if device['errors'] > 20:
-                backofftime = 3
-                self.core.log(f"Too many errors for [{device['name']}] status. backing off, for {backofftime} minutes")
-                device['hardware'] = Device(device['cfg']['id'], "", device['cfg']['token'])
-                device['hardware'].logger = self.core.log
-                device['errors'] = 0
-                device['last_status'] = datetime.datetime.now() + datetime.timedelta(minutes=backofftime)
+        # get the device status, a slow device does not hold back the others
+        for session in self.sessions.values():
+            hardware = session['hardware']
+            if session['id'] in self.refresh_tasks or hardware.address == "":
+                continue
+
+            # connected devices push their changes, the poll is only a fallback
+            if hardware.is_connected():
+                due = self.elapsed(session['last_status'], self.connected_refresh_interval)
+            else:
+                due = session['health'].is_due()
+
+            if due:
+                self.refresh_tasks[session['id']] = self.core.create_task(self.refresh(session))
+
+        # sleep until the next session is due, discovery and reconnects wake the job earlier
+        delays = []
+        for session in self.sessions.values():
+            hardware = session['hardware']
+            if hardware.address == "":
+                continue
+
+            if session['id'] in self.refresh_tasks:
+                delays.append(self.refresh_interval)
+            elif hardware.is_connected():
+                last_status = session['last_status']
+                elapsed = (datetime.datetime.now() - last_status).total_seconds() if last_status else self.connected_refresh_interval
+                delays.append(self.connected_refresh_interval - elapsed)
+            else:
+                delays.append(session['health'].delay())
+
+        return next_delay(delays, self.slow_refresh_interval)
+
+    async def refresh(self, session):
+        # the poll job only spawns these, so the job metrics are recorded here
+        job = self.hardware_type() + ".refresh"
+        scheduler = self.core.scheduler
+        hardware = session['hardware']
+        try:
+            async with self.refresh_slots:
+                #self.log(f"Refreshing device [{session['name']}] status. seqno {hardware.seqno}")
+                start = self.loop.time()
+                try:
+                    result = await asyncio.wait_for(hardware.status(), timeout=self.refresh_timeout)
+                except asyncio.TimeoutError:
+                    result = error_json("status timeout")
+                except Exception as exception:
+                    self.log_exception(f"Failed to refresh [{session['name']}]", exception)
+                    result = error_json("status failed")
+                scheduler.metric_duration.observe(self.loop.time() - start, job)
+        finally:
+            self.refresh_tasks.pop(session['id'], None)
+
+        if result is None or 'error' in result:
+            scheduler.metric_errors.inc(job)
+
+        self.apply_status(session['id'], result)
+
+    async def keep_alive(self):
+        # heartbeat open sockets and reconnect the dropped ones
+        now = time.monotonic()
+        requests = []
+        reconnecting = False
+        for session in self.sessions.values():
+            hardware = session['hardware']
+            if hardware.address == "" or session['health'].is_open():
                 continue
 
-            if self.elapsed(device['last_status'], self.refresh_interval):
-                hardware = device['hardware']
+            if not hardware.is_connected():
+                requests.append(hardware.connect())
+                reconnecting = True
+            elif now - hardware.connection.last_activity >= self.heartbeat_interval:
+                requests.append(hardware.heartbeat())
 
-                if hardware.address != "":
-                    #self.core.log(f"{index} Refreshing device [{device['name']}] status. seqno {hardware.seqno}")
-                    result = await hardware.status()
-                    #self.core.log(f"{index} Done Refreshing device [{device['name']}] status. seqno {hardware.seqno}")
-                    self.apply_status(device['cfg']['id'], result)
-                        
+        await asyncio.gather(*requests)
 
-        if self.status_iterator > 1000:
-            self.status_iterator = 0
\ No newline at end of file
+        # dropped sockets no longer push, let the poll job pick them up
+        if reconnecting:
+            self.wake_job(self.poll_job)
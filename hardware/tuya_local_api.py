@@ -8,6 +8,9 @@ from pickle import NONE
 import struct
 import json
 import binascii
+import contextlib
+import heapq
+import itertools
 import time
 import traceback
 
@@ -48,6 +51,11 @@ PAYLOAD_DICT = {
     },
 }
 
+# Request priorities, lower runs first
+PRIORITY_USER = 0
+PRIORITY_POLL = 1
+PRIORITY_HEARTBEAT = 2
+
 # Protocol Versions and Headers
 PROTOCOL_VERSION_BYTES_31 = b"3.1"
 PROTOCOL_VERSION_BYTES_33 = b"3.3"
@@ -70,10 +78,13 @@ class AESCipher(object):
         self.bs = 16
         self.key = key
 
+        # ecb keeps no state between blocks, the cipher objects are reused
+        self._encryptor = AES.new(self.key, AES.MODE_ECB)
+        self._decryptor = AES.new(self.key, AES.MODE_ECB)
+
     def encrypt(self, raw, use_base64=True):
         raw = self._pad(raw)
-        cipher = AES.new(self.key, mode=AES.MODE_ECB)
-        crypted_text = cipher.encrypt(raw)
+        crypted_text = self._encryptor.encrypt(raw)
 
         if use_base64:
             return base64.b64encode(crypted_text)
@@ -84,8 +95,7 @@ class AESCipher(object):
         if use_base64:
             enc = base64.b64decode(enc)
 
-        cipher = AES.new(self.key, AES.MODE_ECB)
-        raw = cipher.decrypt(enc)
+        raw = self._decryptor.decrypt(enc)
         return self._unpad(raw).decode("utf-8")
 
     def _pad(self, s):
@@ -137,134 +147,354 @@ def error_json(message, payload=None):
     return json.loads('{ "error":"%s", "payload":%s }' % (message, spayload))
 
 
-class NetworkCommand(asyncio.Protocol):
-    def __init__(self, logger, payload, on_con_lost):
-        self.logger = logger
-        self.payload = payload
-        self.on_con_lost = on_con_lost
-        self.received = b""
-        self.received_payload = None
+#
+# Frame Decoder
+# - accumulates the stream in a bytearray and yields every complete frame
+# - frames with a bad crc are dropped, garbage before a prefix is skipped
+#
+class FrameDecoder:
+    PREFIX = struct.pack(">I", PREFIX_VALUE)
+    HEADER_LEN = struct.calcsize(MESSAGE_RECV_HEADER_FMT)
+    END_LEN = struct.calcsize(MESSAGE_END_FMT)
+
+    # real frames are a few hundred bytes, a bigger length is garbage
+    MAX_LENGTH = 4096
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+        self.length_errors = 0
+
+    def clear(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+        frames = []
+        view = memoryview(self.buffer)
+        offset = 0
+        try:
+            while True:
+                start = self.buffer.find(self.PREFIX, offset)
+                if start < 0:
+                    # keep a partial prefix that may complete with the next read
+                    offset = max(offset, len(self.buffer) - 3)
+                    break
+                offset = start
+
+                if len(self.buffer) - offset < self.HEADER_LEN:
+                    break
+
+                # length includes retcode (when present), payload, crc and suffix
+                _, seqno, cmd, length, retcode = struct.unpack_from(MESSAGE_RECV_HEADER_FMT, self.buffer, offset)
+                if length < self.END_LEN or length > self.MAX_LENGTH:
+                    # resync on the next prefix instead of waiting for bytes that never come
+                    self.length_errors = self.length_errors + 1
+                    offset = offset + 4
+                    continue
+
+                end = offset + self.HEADER_LEN - 4 + length
+                if end > len(self.buffer):
+                    break
+
+                crc, _ = struct.unpack_from(MESSAGE_END_FMT, self.buffer, end - self.END_LEN)
+                if binascii.crc32(view[offset : end - self.END_LEN]) & 0xFFFFFFFF != crc:
+                    self.crc_errors = self.crc_errors + 1
+                    offset = offset + 4
+                    continue
+
+                if (retcode & 0xFFFFFF00) != 0:
+                    payload_start = offset + self.HEADER_LEN - 4
+                else:
+                    payload_start = offset + self.HEADER_LEN
+
+                payload = bytes(view[payload_start : end - self.END_LEN])
+                frames.append(TuyaMessage(seqno, cmd, retcode, payload, crc))
+                offset = end
+        finally:
+            view.release()
+
+        if offset:
+            del self.buffer[:offset]
+
+        return frames
+
+
+#
+# Device Connection
+# - one long lived socket per physical device
+# - replies are matched to the waiting request by command
+# - frames nobody waits for (pushed dps updates) go to on_message
+#
+class DeviceConnection(asyncio.Protocol):
+    def __init__(self, dev_id, address="", port=6668):
+        self.logger = defaultLogger
+        self.id = dev_id
+        self.address = address
+        self.port = port
+        self.connection_timeout = 8
+        self.on_message = None
+
         self.transport = None
+        self.decoder = FrameDecoder()
+        self.pending = {}
+        self.connecting = asyncio.Lock()
+        self.last_activity = 0.0
+
+    def is_connected(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    async def connect(self):
+        if self.is_connected():
+            return True
+        if self.address == "":
+            return False
+
+        async with self.connecting:
+            if self.is_connected():
+                return True
+
+            loop = asyncio.get_running_loop()
+            try:
+                connection_coroutine = loop.create_connection(lambda: self, self.address, self.port)
+                await asyncio.wait_for(connection_coroutine, timeout=self.connection_timeout)
+            except Exception:
+                return False
+
+            return self.is_connected()
+
+    def close(self):
+        transport = self.transport
+        self.transport = None
+        try:
+            if transport and not transport.is_closing():
+                transport.close()
+        except Exception:
+            pass
+        self._fail_pending()
+
+    def _fail_pending(self):
+        pending = self.pending
+        self.pending = {}
+        for waiting in pending.values():
+            for future in waiting:
+                if not future.done():
+                    future.set_exception(ConnectionError("connection closed"))
+
+    async def request(self, payload, cmd):
+        if not await self.connect():
+            raise ConnectionError(f"unable to connect to {self.address}")
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(cmd, []).append(future)
+        self.transport.write(payload)
+
+        try:
+            return await asyncio.wait_for(future, timeout=self.connection_timeout)
+        except asyncio.TimeoutError:
+            # a silent socket is stale, the next request reconnects
+            self.close()
+            raise
+        finally:
+            waiting = self.pending.get(cmd)
+            if waiting and future in waiting:
+                waiting.remove(future)
+
+    def _resolve(self, cmd, message):
+        for future in self.pending.get(cmd, []):
+            if not future.done():
+                future.set_result(message)
+                return True
+        return False
 
     def connection_made(self, transport):
-        #self.logger("Connected")
         self.transport = transport
-        transport.write(self.payload)
+        self.decoder.clear()
+        self.last_activity = time.monotonic()
 
-    def data_received(self, data):
-        #self.logger(f"Received: {data}")
-        self.received += data
+    def connection_lost(self, exc):
+        self.transport = None
+        self._fail_pending()
 
-        header_len = struct.calcsize(MESSAGE_RECV_HEADER_FMT)
-        # Check if enough data for measage header
-        if len(self.received) < header_len:
-            return
+    def data_received(self, data):
+        self.last_activity = time.monotonic()
 
-        # Parse header and check if enough data according to length in header
-        _, seqno, cmd, length, retcode = struct.unpack_from(MESSAGE_RECV_HEADER_FMT, self.received)
-        if len(self.received[header_len - 4 :]) < length:
-            return
+        for message in self.decoder.feed(data):
+            if self._resolve(message.cmd, message):
+                continue
 
-        # length includes payload length, retcode, crc and suffix
-        if (retcode & 0xFFFFFF00) != 0:
-            payload_start = header_len - 4
-            payload_length = length - struct.calcsize(MESSAGE_END_FMT)
-        else:
-            payload_start = header_len
-            payload_length = length - 4 - struct.calcsize(MESSAGE_END_FMT)
+            # some devices answer a set with the status push alone
+            if message.cmd == 0x08:
+                self._resolve(0x07, message)
 
-        payload = self.received[payload_start : payload_start + payload_length]
+            if self.on_message:
+                try:
+                    self.on_message(message)
+                except Exception as exception:
+                    self.logger(f"Tuya {self.id} message handler failed {exception}")
 
-        crc, _ = struct.unpack_from(MESSAGE_END_FMT,
-            self.received[payload_start + payload_length : payload_start + length])
 
-        self.received = self.received[header_len - 4 + length :]
-        self.received_payload = TuyaMessage(seqno, cmd, retcode, payload, crc)
+#
+# Request Queue
+# - one request at a time on a device
+# - waiting requests are served by priority, then in arrival order
+#
+class RequestQueue:
+    def __init__(self):
+        self.waiting = []
+        self.counter = itertools.count()
+        self.busy = False
 
+    @contextlib.asynccontextmanager
+    async def turn(self, priority):
+        await self._acquire(priority)
         try:
-            if not self.transport.is_closing():
-                self.transport.close()
-        except:
-            pass
+            yield
+        finally:
+            self._release()
 
-        self.on_con_lost.set_result(True)
-        #self.logger("Done")
+    async def _acquire(self, priority):
+        if not self.busy:
+            self.busy = True
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the turn was handed over right before the cancellation
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.busy = False
 
 
 class Device:
     def __init__(self, dev_id, address, local_key=""):
         self.logger = defaultLogger
         self.id = dev_id
-        self.address = address
         self.local_key = local_key.encode("latin1")
-        self.connection_timeout = 8
         self.connection_attempts = 3
         self.version = 3.3
         self.dev_type = "type_0a"
-        self.port = 6668  # default - do not expect caller to pass in
         self.cipher = AESCipher(self.local_key)
         self.seqno = 0
         self.dps_to_request = {}
-        self.communicating = False
+        self.on_status = None
 
-    async def _send_receive(self, payload):
-        if self.communicating:
-            return error_json("device already in use")
-        
-        self.communicating = True
+        # request bodies per dev_type, filled with this device id once
+        self.templates = {}
+        self.static_payloads = {}
 
-        loop = asyncio.get_running_loop()
-        received_payload = None
-        transport = None
-        
-        attempts = self.connection_attempts
-        while attempts > 0:
-            try:
-                on_done = loop.create_future()
-                factory = lambda: NetworkCommand(self.logger, payload, on_done) 
-                connection_coroutine = loop.create_connection(factory, self.address, self.port)
-                transport, protocol = await asyncio.wait_for(connection_coroutine, timeout=self.connection_timeout)
-
-                await asyncio.wait_for(on_done, timeout=self.connection_timeout)
-                received_payload = protocol.received_payload.payload
-                break
-                
-            except Exception as exception:
-                attempts = attempts - 1
-           
-                #data = "_send_receive ".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
-                #self.logger(data)
-                if attempts > 0:
-                    await asyncio.sleep(1)
-            finally:
+        # user actions go ahead of background polls
+        self.requests = RequestQueue()
 
-                try:
-                    connection_coroutine.close()
-                except:
-                    pass
-                
-                try:
-                    if not transport.is_closing():
-                        transport.close()
-                except:
-                    pass
-        
-        if received_payload is None:
-            result = error_json("empty payload")
+        # a poll is answered from here when a status arrived moments ago
+        self.status_cache = None
+        self.status_time = 0.0
+        self.status_max_age = 1.0
+
+        self.connection = DeviceConnection(dev_id, address)
+        self.connection.on_message = self._message_received
+
+    @property
+    def address(self):
+        return self.connection.address
+
+    @address.setter
+    def address(self, address):
+        if self.connection.address != address:
+            self.connection.close()
+            self.connection.address = address
+
+    def is_connected(self):
+        return self.connection.is_connected()
+
+    async def connect(self):
+        return await self.connection.connect()
+
+    def close(self):
+        self.connection.close()
+
+    def _message_received(self, message):
+        # unsolicited frames carry the dps that changed on the device
+        try:
+            result = self._decode_payload(message.payload)
+        except Exception:
+            return
+
+        if not isinstance(result, dict) or 'error' in result:
+            return
+
+        self._update_status_cache(result, partial=True)
+        if self.on_status:
+            self.on_status(self.id, result)
+
+    def _update_status_cache(self, result, partial=False):
+        if 'dps' not in result:
+            return
+
+        # pushes only carry the changed dps, merge them into the last full status
+        if partial:
+            if self.status_cache is None:
+                return
+            self.status_cache['dps'].update(result['dps'])
         else:
-            try:
-                result = self._decode_payload(received_payload)
-            except Exception as e:
-                self.logger("error unpacking or decoding tuya JSON payload")
-                result = error_json("invalid payload")
+            self.status_cache = {'dps': dict(result['dps'])}
+        self.status_time = time.monotonic()
 
+    def _cached_status(self):
+        if self.status_cache is None or time.monotonic() - self.status_time > self.status_max_age:
+            return None
+        return {'dps': dict(self.status_cache['dps'])}
 
-        # reset devices
-        if self.seqno > 10:
-            self.seqno = 0
-            #self.logger(f"reseted sequence number for device {self.address}")
+    async def _send_receive(self, payload, cmd, priority=PRIORITY_USER):
+        received_payload = None
+        
+        async with self.requests.turn(priority):
+            # a poll that waited behind other requests may already be answered
+            if priority == PRIORITY_POLL:
+                cached = self._cached_status()
+                if cached is not None:
+                    return cached
+
+            attempts = self.connection_attempts
+            while attempts > 0:
+                try:
+                    message = await self.connection.request(payload, cmd)
+                    received_payload = message.payload
+                    break
+                    
+                except Exception as exception:
+                    attempts = attempts - 1
+               
+                    #data = "_send_receive ".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+                    #self.logger(data)
+                    if attempts > 0:
+                        await asyncio.sleep(1)
+            
+            if received_payload is None:
+                result = error_json("empty payload")
+            else:
+                try:
+                    result = self._decode_payload(received_payload)
+                except Exception as e:
+                    self.logger("error unpacking or decoding tuya JSON payload")
+                    result = error_json("invalid payload")
 
-        self.communicating = False
+            # reset devices
+            if self.seqno > 10:
+                self.seqno = 0
+                #self.logger(f"reseted sequence number for device {self.address}")
 
         return result
 
@@ -297,31 +527,54 @@ class Device:
 
         return json.loads(payload)
 
+    def _template(self, command):
+        key = (self.dev_type, command)
+        template = self.templates.get(key)
+        if template is None:
+            template = dict(PAYLOAD_DICT[self.dev_type][command]["command"])
+            if "gwId" in template:
+                template["gwId"] = self.id
+            if "devId" in template:
+                template["devId"] = self.id
+            if "uid" in template:
+                template["uid"] = self.id  # still use id, no separate uid
+            self.templates[key] = template
+        return template
+
     def generate_payload(self, command, data=None):
-        cmd_data = PAYLOAD_DICT[self.dev_type][command]
-        json_data = cmd_data["command"]
-        command_hb = cmd_data["hexByte"]
-
-        if "gwId" in json_data:
-            json_data["gwId"] = self.id
-        if "devId" in json_data:
-            json_data["devId"] = self.id
-        if "uid" in json_data:
-            json_data["uid"] = self.id  # still use id, no separate uid
-        if "t" in json_data:
-            json_data["t"] = str(int(time.time()))
-
-        if data is not None:
-            if "dpId" in json_data:
-                json_data["dpId"] = data
-            else:
-                json_data["dps"] = data
-        elif command_hb == 0x0D:
-            json_data["dps"] = self.dps_to_request
+        command_hb = PAYLOAD_DICT[self.dev_type][command]["hexByte"]
+        template = self._template(command)
+
+        # bodies without time or dps (heartbeat, type_0a status) are encrypted once
+        static = data is None and "t" not in template and command_hb != 0x0D
+        key = (self.dev_type, command)
+        payload = self.static_payloads.get(key) if static else None
+
+        if payload is None:
+            json_data = dict(template)
+            if "t" in json_data:
+                json_data["t"] = str(int(time.time()))
+
+            if data is not None:
+                if "dpId" in json_data:
+                    json_data["dpId"] = data
+                else:
+                    json_data["dps"] = data
+            elif command_hb == 0x0D:
+                json_data["dps"] = self.dps_to_request
+
+            payload = json.dumps(json_data, separators=(",", ":")).encode("utf-8")
+            #self.logger(f"Send payload: {payload}")
+
+            payload = self._encode_payload(command, command_hb, payload)
+            if static:
+                self.static_payloads[key] = payload
 
-        payload = json.dumps(json_data).replace(" ", "").encode("utf-8")
-        #self.logger(f"Send payload: {payload}")
+        msg = TuyaMessage(self.seqno, command_hb, 0, payload, 0)
+        self.seqno += 1
+        return pack_message(msg)
 
+    def _encode_payload(self, command, command_hb, payload):
         if self.version == 3.3:
             payload = self.cipher.encrypt(payload, False)
             if command_hb not in [0x0A, 0x12]:
@@ -345,28 +598,55 @@ class Device:
                 + hexdigest[8:][:16].encode("latin1")
                 + payload
             )
+        return payload
 
-        msg = TuyaMessage(self.seqno, command_hb, 0, payload, 0)
-        self.seqno += 1
-        return pack_message(msg)
+    def _command_byte(self, command):
+        return PAYLOAD_DICT[self.dev_type][command]["hexByte"]
 
     async def status(self):
+        cached = self._cached_status()
+        if cached is not None:
+            return cached
+
         payload = self.generate_payload(STATUS)
-        return await self._send_receive(payload)
+        result = await self._send_receive(payload, self._command_byte(STATUS), PRIORITY_POLL)
+        if isinstance(result, dict) and 'error' not in result:
+            self._update_status_cache(result)
+        return result
+
+    async def heartbeat(self):
+        # keeps the socket open, a request already on the wire does that too,
+        # a heartbeat timeout closes the socket so it never runs beside one
+        if self.requests.busy:
+            return True
+
+        async with self.requests.turn(PRIORITY_HEARTBEAT):
+            payload = self.generate_payload(HEARTBEAT)
+            try:
+                await self.connection.request(payload, self._command_byte(HEARTBEAT))
+                return True
+            except Exception:
+                return False
 
     async def set_status(self, on, switch=1):
         if isinstance(switch, int):
             switch = str(switch)  # index and payload is a string
 
-        payload = self.generate_payload(SET, {switch: on})
-        return await self._send_receive(payload)
+        return await self._set({switch: on})
 
     async def set_value(self, index, value):
         if isinstance(index, int):
             index = str(index)  # index and payload is a string
 
-        payload = self.generate_payload(SET, {index: value})
-        return await self._send_receive(payload)
+        return await self._set({index: value})
+
+    async def _set(self, dps):
+        payload = self.generate_payload(SET, dps)
+        try:
+            return await self._send_receive(payload, self._command_byte(SET))
+        finally:
+            # even a failed set may have reached the device, the next poll must ask it
+            self.status_cache = None
 
     async def turn_on(self, switch=1):
         return await self.set_status(True, switch)
@@ -377,10 +657,19 @@ class Device:
 #
 # Device Discovery
 #
+#
+# - devices are indexed by gwId, on_discovered only fires for new ips
+# - devices repeat the same announcements every few seconds (on 6666 and
+#   6667 with different payloads), the crc of a datagram already decoded
+#   maps straight to its gwId without decrypting it again
+#
 class TuyaDiscovery(asyncio.DatagramProtocol):
     def __init__(self):
         self.devices = {}
+        self.on_discovered = None
+        self.on_seen = None
         self._listeners = []
+        self._checksums = {}
 
         UDP_KEY = md5(b"yGAdlopoPVldABfn").digest()
         self._cipher = AESCipher(UDP_KEY)
@@ -397,17 +686,41 @@ class TuyaDiscovery(asyncio.DatagramProtocol):
             transport.close()
 
     def datagram_received(self, data, addr):
+        checksum = binascii.crc32(data)
+        gwId = self._checksums.get(checksum)
+        if gwId is not None:
+            # a repeated announcement still tells the device is alive
+            if self.on_seen:
+                self.on_seen(gwId)
+            return
 
         data = data[20:-8]
         try:
             data = self._cipher.decrypt(data, False)
         except Exception:  # pylint: disable=broad-except
-            data = data.decode()
+            data = data.decode(errors="ignore")
 
-        device = json.loads(data)
+        try:
+            device = json.loads(data)
+        except ValueError:
+            return
 
         #defaultLogger(f"datagram_received payload: {device}")
 
-        self.devices[device.get("gwId")] = device
+        gwId = device.get("gwId")
+        if gwId is None:
+            return
+
+        if len(self._checksums) > 256:
+            self._checksums.clear()
+        self._checksums[checksum] = gwId
+
+        previous = self.devices.get(gwId)
+        self.devices[gwId] = device
+
+        if previous is not None and previous.get("ip") == device.get("ip"):
+            if self.on_seen:
+                self.on_seen(gwId)
+        elif self.on_discovered:
+            self.on_discovered(gwId, device)
 
-        
\ No newline at end of file
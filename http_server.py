@@ -1,10 +1,47 @@
 import asyncio
+import gzip
 import json
+import mimetypes
 import pathlib
 import datetime
+import time
 
 from aiohttp import web
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+#
+# Device Stream
+# - collects the changes for a single /api/device/stream client
+#
+class DeviceStream:
+    def __init__(self):
+        self.changed = {}
+        self.snapshot = True
+        self.closed = False
+        self.event = asyncio.Event()
+
+    def device_changed(self, device):
+        if device is None:
+            self.snapshot = True
+        else:
+            # only the latest state of each device is sent
+            self.changed[device['id']] = device
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+
+DEVICE_ACTIONS = ["enable", "disable", "open", "close", "stop"]
+
+
 class HttpServer:
 
     def __init__(self):
@@ -12,6 +49,16 @@ class HttpServer:
         self.application = None
         self.core = None
         self.json_indent = 4
+        self.gzip_min_size = 1024
+        self.gzip_level = 5
+        self.device_list_obj = None
+        self.device_list_body = None
+        self.device_list_gzip = None
+        self.device_list_version = -1
+        self.streams = []
+        self.stream_keepalive = 15
+        self.static_roots = []
+        self.static_immutable = set()
 
     #
     # Runtime Handlers
@@ -22,49 +69,183 @@ class HttpServer:
         response_obj = {
             'version': self.core.version,
             'uptime': str(datetime.timedelta(seconds=delta)), 
+            'startup': list(self.core.timeline),
+            'jobs': self.core.scheduler.get_status(),
             'status': 'success'
         }
-        return web.Response(text=self.to_json(response_obj))
+        return self.json_response(request, response_obj)
 
     async def handle_maintenance_log(self, request):
-        lines = self.core.log_history.copy()
-        lines.reverse();
+        try:
+            since = int(request.query.get('since', 0))
+        except ValueError:
+            since = 0
+
+        logger = self.core.logger
+        records = logger.get_records(since, request.query.get('level'), request.query.get('source'))
+        headers = {'X-Log-Seq': str(logger.get_seq())}
+
+        if request.query.get('format') == 'json':
+            return self.json_response(request, records, headers=headers)
+
+        lines = []
+        for record in records:
+            lines.extend(logger.format(record).splitlines())
+        lines.reverse()
         data = "\n".join(lines)
-        return web.Response(text=data)        
+        return self.body_response(request, data.encode("utf-8"), headers=headers, content_type='text/plain')
 
     async def handle_maintenance_clear_log(self, request):
         self.core.clear_log()
         return await self.handle_maintenance_log(request)
 
     async def handle_maintenance_restart(self, request):
-        self.core.restart = True
-        self.core.running = False
+        self.core.stop(restart=True)
         response_obj = {'status': 'success'}
-        return web.Response(text=self.to_json(response_obj))
+        return self.json_response(request, response_obj)
+
+    async def handle_maintenance_metrics(self, request):
+        return web.Response(body=self.core.metrics.render().encode("utf-8"), 
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def handle_maintenance_reload(self, request):
+        result = await self.core.reload()
+        response_obj = {'status': 'success' if result else 'error'}
+        return self.json_response(request, response_obj)
 
     async def handle_maintenance_shutdown(self, request):
-        self.core.running = False
+        self.core.stop()
         response_obj = {'status': 'success'}
-        return web.Response(text=self.to_json(response_obj))
+        return self.json_response(request, response_obj)
 
     #
     # Device Handlers
     #
+    async def get_device_list_body(self, pretty=False):
+        # serialized once per state version and shared by every client
+        version = self.core.state_version
+        if self.device_list_version != version:
+            groups, records = await self.core.get_device_list()
+            self.device_list_obj = {
+                'status': 'ok',
+                'groups': groups,
+                'devices': records
+            }
+            self.device_list_body = self.to_json(self.device_list_obj)
+            self.device_list_gzip = None
+            self.device_list_version = version
+
+        if pretty:
+            return self.to_json(self.device_list_obj, pretty=True)
+        return self.device_list_body
+
+    def get_device_list_gzip(self, body):
+        # compressed on the first request that accepts gzip for this version
+        if self.device_list_gzip is None:
+            self.device_list_gzip = self.compress(body)
+        return self.device_list_gzip
+
     async def handle_device_list(self, request):
-        groups, records = await self.core.get_device_list()
-        response_obj = {
-            'status': 'ok',
-            'groups': groups,
-            'devices': records
-        }
-        return web.Response(text=self.to_json(response_obj))
+        etag = f'"{self.core.instance}-{self.core.state_version}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+
+        pretty = self.is_pretty(request)
+        body = await self.get_device_list_body(pretty)
+        compress = self.compress if pretty else self.get_device_list_gzip
+        return self.body_response(request, body, headers=headers, compress=compress)
+
+    def stream_event(self, event, data):
+        # compact json never spans more than one line
+        return b"event: " + event.encode("utf-8") + b"\ndata: " + data + b"\n\n"
+
+    async def handle_device_stream(self, request):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache'
+        })
+        await response.prepare(request)
+
+        stream = DeviceStream()
+        self.streams.append(stream)
+        self.core.add_device_listener(stream.device_changed)
+
+        try:
+            while not stream.closed:
+                if stream.snapshot:
+                    stream.snapshot = False
+                    stream.changed = {}
+                    body = await self.get_device_list_body()
+                    await response.write(self.stream_event("snapshot", body))
+
+                changed = stream.changed
+                stream.changed = {}
+                for device in changed.values():
+                    delta = {'id': device['id'], 'state': device['state']}
+                    await response.write(self.stream_event("state", self.to_json(delta)))
+
+                if stream.snapshot or stream.changed or stream.closed:
+                    continue
+
+                stream.event.clear()
+                try:
+                    await asyncio.wait_for(stream.event.wait(), timeout=self.stream_keepalive)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+
+        except ConnectionResetError:
+            pass
+        finally:
+            self.core.remove_device_listener(stream.device_changed)
+            self.streams.remove(stream)
+
+        return response
 
     async def handle_device_action(self, request, device_id, action):
         result = await self.core.run_device_action(device_id, action)
         response_obj = {
             'status': 'ok' if result else "error"
         }
-        return web.Response(text=self.to_json(response_obj))
+
+        # virtual devices report the result of each child, for this call only
+        results = getattr(result, 'results', None)
+        if results is not None:
+            response_obj['results'] = results
+
+        return self.json_response(request, response_obj)
+
+    async def handle_device_actions(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+
+        if isinstance(data, dict):
+            data = data.get('actions')
+
+        if (not isinstance(data, list) or 
+            any(not isinstance(i, dict) or i.get('action') not in DEVICE_ACTIONS or 'id' not in i for i in data)):
+            response_obj = {'status': 'error', 'error': 'expected a list of {id, action}'}
+            return self.json_response(request, response_obj, status=400)
+
+        actions = [(str(i['id']), i['action']) for i in data]
+        results = await self.core.run_device_actions(actions)
+
+        items = []
+        for (device_id, action), result in zip(actions, results):
+            items.append({
+                'id': device_id,
+                'action': action,
+                'status': 'ok' if result else 'error'
+            })
+
+        response_obj = {
+            'status': 'ok' if all(results) else 'error',
+            'results': items
+        }
+        return self.json_response(request, response_obj)
 
     async def handle_device_enable(self, request):
         return await self.handle_device_action(request, request.match_info['id'], "enable")
@@ -81,15 +262,111 @@ class HttpServer:
     async def handle_device_stop(self, request):
         return await self.handle_device_action(request, request.match_info['id'], "stop")  
 
+    @web.middleware
+    async def metrics_middleware(self, request, handler):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as exception:
+            status = exception.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource else "unmatched"
+            self.metric_request_duration.observe(time.perf_counter() - start, route)
+            self.metric_requests.inc(route, str(status))
+
     async def root_handler(self, request):
         return web.HTTPFound('/index.html')
 
+    #
+    # Static Files
+    # - static/dist (see scripts/build_static.py) is served first when it was built
+    # - fingerprinted files are cached forever, the entry points are revalidated
+    # - a precompressed .br or .gz variant is sent when the client accepts it
+    #
+    def setup_static(self):
+        root = pathlib.Path(__file__).parent / 'static'
+        dist = root / 'dist'
+        self.static_roots = [root.resolve()]
+        self.static_immutable = set()
+
+        # the source files stay reachable for pages that still use the plain names
+        if (dist / 'index.html').is_file():
+            self.static_roots.insert(0, dist.resolve())
+            try:
+                with open(dist / 'assets.json', encoding='utf-8') as file:
+                    self.static_immutable = set(json.load(file).values())
+            except (OSError, ValueError) as exception:
+                self.core.log_exception("HttpServer static assets", exception)
+
+            self.core.log(f"HttpServer serving {len(self.static_immutable)} built static files")
+
+    async def handle_static(self, request):
+        name = request.match_info['path']
+        for root in self.static_roots:
+            path = (root / name).resolve()
+            if root in path.parents and path.is_file():
+                break
+        else:
+            raise web.HTTPNotFound()
+
+        content_type, _ = mimetypes.guess_type(path.name)
+        headers = {
+            'Content-Type': content_type or 'application/octet-stream',
+            'Vary': 'Accept-Encoding'
+        }
+
+        if name in self.static_immutable:
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+
+        accept = request.headers.get('Accept-Encoding', '')
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            variant = path.with_name(path.name + suffix)
+            if encoding in accept and variant.is_file():
+                headers['Content-Encoding'] = encoding
+                path = variant
+                break
+
+        return web.FileResponse(path, headers=headers)
+
     def json_converter(o):
         if isinstance(o, datetime.datetime):
             return o.isoformat()
 
-    def to_json(self, data):
-        return json.dumps(data, indent=self.json_indent, default=HttpServer.json_converter)
+    def to_json(self, data, pretty=False):
+        if pretty:
+            return json.dumps(data, indent=self.json_indent, default=HttpServer.json_converter).encode("utf-8")
+        if orjson:
+            return orjson.dumps(data, default=HttpServer.json_converter)
+        return json.dumps(data, separators=(',', ':'), default=HttpServer.json_converter).encode("utf-8")
+
+    def is_pretty(self, request):
+        return request.query.get('pretty') == '1'
+
+    def compress(self, body):
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    def accepts_gzip(self, request, body):
+        if len(body) < self.gzip_min_size:
+            return False
+        return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    def body_response(self, request, body, status=200, headers=None, compress=None, content_type='application/json'):
+        headers = dict(headers or {})
+        headers['Vary'] = 'Accept-Encoding'
+        if self.accepts_gzip(request, body):
+            body = (compress or self.compress)(body)
+            headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=body, status=status, headers=headers, content_type=content_type)
+
+    def json_response(self, request, data, status=200, headers=None):
+        return self.body_response(request, self.to_json(data, self.is_pretty(request)), status, headers)
 
     #
     # Pump
@@ -100,15 +377,23 @@ class HttpServer:
 
         core.log(f"HttpServer starting pump on {port}...")
         self.core = core
-        self.application = web.Application()
+        self.metric_request_duration = core.metrics.histogram(
+            "magicwand_http_request_duration_seconds", "HTTP request latency by route", ("route",))
+        self.metric_requests = core.metrics.counter(
+            "magicwand_http_requests_total", "HTTP requests by route and status", ("route", "status"))
+        self.application = web.Application(middlewares=[self.metrics_middleware])
 
         self.application.router.add_get("/api/maintenance/status", self.handle_maintenance_status)
         self.application.router.add_get("/api/maintenance/log", self.handle_maintenance_log)
         self.application.router.add_get("/api/maintenance/clear_log", self.handle_maintenance_clear_log)
         self.application.router.add_get("/api/maintenance/shutdown", self.handle_maintenance_shutdown)
         self.application.router.add_get("/api/maintenance/restart", self.handle_maintenance_restart)
+        self.application.router.add_get("/api/maintenance/reload", self.handle_maintenance_reload)
+        self.application.router.add_get("/api/maintenance/metrics", self.handle_maintenance_metrics)
 
         self.application.router.add_get("/api/device/list", self.handle_device_list)
+        self.application.router.add_get("/api/device/stream", self.handle_device_stream)
+        self.application.router.add_post("/api/device/actions", self.handle_device_actions)
 
         self.application.router.add_get("/api/device/{id}/enable", self.handle_device_enable)
         self.application.router.add_get("/api/device/{id}/disable", self.handle_device_disable)
@@ -117,18 +402,20 @@ class HttpServer:
         self.application.router.add_get("/api/device/{id}/close", self.handle_device_close)  
         self.application.router.add_get("/api/device/{id}/stop", self.handle_device_stop) 
 
-        root = pathlib.Path(__file__).parent
+        self.setup_static()
         self.application.router.add_route('*', '/', self.root_handler)
-        self.application.router.add_static('/', path=root / 'static', name='static')
+        self.application.router.add_get('/{path:.+}', self.handle_static)
 
-        runner = web.AppRunner(self.application)
-        await runner.setup()
-        site = web.TCPSite(runner, None, port)
-        await site.start()
+        with core.profile("http bind"):
+            runner = web.AppRunner(self.application)
+            await runner.setup()
+            site = web.TCPSite(runner, None, port)
+            await site.start()
 
         # pump
-        while core.running:
-            await asyncio.sleep(1)
+        await core.wait_stopped()
 
         core.log("HttpServer Shutting down")
+        for stream in list(self.streams):
+            stream.close()
         await runner.cleanup()
@@ -0,0 +1,117 @@
+import collections
+import datetime
+import queue
+import sys
+import threading
+
+LEVELS = {
+    'debug': 10,
+    'info': 20,
+    'warning': 30,
+    'error': 40
+}
+
+#
+# Logger
+# - keeps the latest records in a bounded ring buffer
+# - records carry a sequence number, level, source driver and device id
+# - stdout and file output are written by a background thread
+#
+class Logger:
+    def __init__(self, size=250):
+        self.records = collections.deque(maxlen=size)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+        self.output = queue.SimpleQueue()
+        self.writer = None
+        self.file = None
+
+    def resize(self, size):
+        with self.lock:
+            self.records = collections.deque(self.records, maxlen=size)
+
+    def open_file(self, path):
+        self.output.put(('file', path))
+
+    def log(self, message, level='info', source=None, device=None):
+        now = datetime.datetime.now()
+
+        with self.lock:
+            self.seq = self.seq + 1
+            record = {
+                'seq': self.seq,
+                'time': now,
+                'level': level,
+                'source': source,
+                'device': device,
+                'message': str(message)
+            }
+            self.records.append(record)
+
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="logger", daemon=True)
+                self.writer.start()
+
+        self.output.put(('record', record))
+
+        return record
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def get_records(self, since=0, level=None, source=None):
+        with self.lock:
+            records = list(self.records)
+
+        minimum = LEVELS.get(level, 0)
+
+        return [r for r in records if
+            r['seq'] > since and
+            LEVELS.get(r['level'], 0) >= minimum and
+            (source is None or r['source'] == source)]
+
+    def get_seq(self):
+        return self.seq
+
+    def format(self, record):
+        timestamp = record['time'].isoformat(sep=' ', timespec='milliseconds')
+        if record['level'] == 'info':
+            return timestamp + " " + record['message']
+        return timestamp + " " + record['level'].upper() + " " + record['message']
+
+    def stop(self):
+        # flush pending output before the process goes away
+        if self.writer:
+            self.output.put(('stop', None))
+            self.writer.join()
+            self.writer = None
+
+    def _write_loop(self):
+        while True:
+            kind, value = self.output.get()
+
+            try:
+                if kind == 'stop':
+                    break
+
+                if kind == 'file':
+                    if self.file:
+                        self.file.close()
+                    self.file = open(value, "a", encoding="utf-8")
+                    continue
+
+                line = self.format(value) + "\n"
+                sys.stdout.write(line)
+                sys.stdout.flush()
+
+                if self.file:
+                    self.file.write(line)
+                    self.file.flush()
+            except Exception:
+                pass
+
+        if self.file:
+            self.file.close()
+            self.file = None
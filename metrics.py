@@ -0,0 +1,139 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+#
+# Metric Types
+#
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self, lines):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.collect = collect
+        self.lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render(self, lines):
+        # a collect callback reads the values at scrape time
+        if self.collect:
+            values = list(self.collect().items())
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            record = self.values.get(label_values)
+            if record is None:
+                record = [[0] * len(self.buckets), 0.0, 0]
+                self.values[label_values] = record
+            if index < len(self.buckets):
+                record[0][index] = record[0][index] + 1
+            record[1] = record[1] + value
+            record[2] = record[2] + 1
+
+    def render(self, lines):
+        with self.lock:
+            values = [(k, (list(v[0]), v[1], v[2])) for k, v in self.values.items()]
+
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative = cumulative + bucket
+                le = 'le="' + _number(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+
+#
+# Metrics Registry
+# - renders every metric in the prometheus text format
+#
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self._add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,143 @@
+import asyncio
+
+#
+# Job - a timed piece of work owned by a driver
+#
+class Job:
+    def __init__(self, name, interval, callback):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+
+        self.deadline = 0.0
+        self.task = None
+        self.woken = False
+
+        self.runs = 0
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.duration = 0.0
+
+    def is_running(self):
+        return self.task is not None
+
+
+#
+# Scheduler
+# - sleeps until the next job deadline instead of ticking
+# - jobs can be woken to run right away (new discovery, completed action...)
+# - a job callback may return the delay in seconds until its next run
+#
+class Scheduler:
+    def __init__(self, core):
+        self.core = core
+        self.jobs = []
+        self.wakeup = asyncio.Event()
+
+        self.metric_duration = core.metrics.histogram(
+            "magicwand_job_duration_seconds", "Scheduler job (driver poll) duration", ("job",))
+        self.metric_errors = core.metrics.counter(
+            "magicwand_job_errors_total", "Scheduler job (driver poll) failures", ("job",))
+        self.metric_lag = core.metrics.histogram(
+            "magicwand_loop_lag_seconds", "Delay between a job deadline and its start",
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+    def now(self):
+        return asyncio.get_event_loop().time()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def add_job(self, name, interval, callback, delay=0.0):
+        job = Job(name, interval, callback)
+        job.deadline = self.now() + delay
+        self.jobs.append(job)
+        self.notify()
+        return job
+
+    async def remove_job(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+        # let a running callback finish before its owner is torn down
+        if job.task:
+            try:
+                await job.task
+            except Exception:
+                pass
+
+    def wake(self, job, delay=0.0):
+        if job is None:
+            return
+
+        if job.is_running():
+            job.woken = True
+        else:
+            job.deadline = min(job.deadline, self.now() + delay)
+            self.notify()
+
+    def _start(self, job, now):
+        job.lateness = now - job.deadline
+        job.max_lateness = max(job.max_lateness, job.lateness)
+        self.metric_lag.observe(job.lateness)
+        job.woken = False
+        job.task = self.core.create_task(self._run_job(job))
+
+    async def _run_job(self, job):
+        start = self.now()
+        interval = job.interval
+        try:
+            result = await job.callback()
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                interval = result
+        except Exception as exception:
+            self.metric_errors.inc(job.name)
+            self.core.log_exception(f"job {job.name}", exception)
+        finally:
+            end = self.now()
+            self.metric_duration.observe(end - start, job.name)
+            job.runs = job.runs + 1
+            job.duration = end - start
+            job.deadline = end if job.woken else end + interval
+            job.task = None
+            self.notify()
+
+    def get_status(self):
+        now = self.now()
+        status = []
+        for job in self.jobs:
+            status.append({
+                'name': job.name,
+                'interval': job.interval,
+                'runs': job.runs,
+                'running': job.is_running(),
+                'next': round(max(job.deadline - now, 0.0), 3),
+                'duration': round(job.duration, 3),
+                'lateness': round(job.lateness, 3),
+                'max_lateness': round(job.max_lateness, 3)
+            })
+        return status
+
+    #
+    # Pump
+    #
+    async def run(self):
+        while self.core.running:
+            self.wakeup.clear()
+
+            now = self.now()
+            next_deadline = None
+            for job in list(self.jobs):
+                if job.is_running():
+                    continue
+
+                if job.deadline <= now:
+                    self._start(job, now)
+                elif next_deadline is None or job.deadline < next_deadline:
+                    next_deadline = job.deadline
+
+            timeout = None if next_deadline is None else next_deadline - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# Static build
+# - fingerprints the static assets (name.<hash>.ext) so they can be cached forever
+# - rewrites the references in html, css, js and the web manifest
+# - precompresses the text assets with gzip (and brotli when the module is installed)
+#
+# usage: python scripts/build_static.py
+# output goes to static/dist, which the http server prefers when it exists
+#
+import gzip
+import hashlib
+import json
+import pathlib
+import posixpath
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent / "static"
+DIST = ROOT / "dist"
+
+# served with no-cache so clients pick up new fingerprints
+ENTRY_POINTS = ["index.html", "sw.js"]
+
+TEXT_SUFFIXES = [".html", ".css", ".js", ".svg", ".webmanifest", ".json", ".ico"]
+REWRITE_SUFFIXES = [".html", ".css", ".js", ".webmanifest"]
+MIN_COMPRESS_SIZE = 256
+
+
+def fingerprint(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    path = pathlib.PurePosixPath(name)
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}"))
+
+
+def rewrite(name, data, assets):
+    text = data.decode("utf-8")
+    folder = posixpath.dirname(name)
+
+    for original, hashed in assets.items():
+        relative = posixpath.relpath(original, folder or ".")
+        # only quoted or url() references, absolute or relative to this file
+        pattern = r"""(["'(])(/""" + re.escape(original) + "|" + re.escape(relative) + r""")(["')?#])"""
+
+        def replace(match):
+            if match.group(2).startswith("/"):
+                target = "/" + hashed
+            else:
+                target = posixpath.relpath(hashed, folder or ".")
+            return match.group(1) + target + match.group(3)
+
+        text = re.sub(pattern, replace, text)
+
+    return text.encode("utf-8")
+
+
+def references(name, data, names):
+    if pathlib.PurePosixPath(name).suffix not in REWRITE_SUFFIXES:
+        return []
+    text = data.decode("utf-8")
+    folder = posixpath.dirname(name)
+    return [n for n in names if n != name and
+        ("/" + n in text or posixpath.relpath(n, folder or ".") in text)]
+
+
+def compress(path, data):
+    if path.suffix not in TEXT_SUFFIXES or len(data) < MIN_COMPRESS_SIZE:
+        return
+
+    path.with_name(path.name + ".gz").write_bytes(gzip.compress(data, compresslevel=9))
+    if brotli:
+        path.with_name(path.name + ".br").write_bytes(brotli.compress(data))
+
+
+def build():
+    sources = {}
+    for path in sorted(ROOT.rglob("*")):
+        if path.is_file() and DIST not in path.parents:
+            sources[path.relative_to(ROOT).as_posix()] = path.read_bytes()
+
+    if DIST.exists():
+        shutil.rmtree(DIST)
+
+    # an asset is fingerprinted after everything it references
+    assets = {}
+    pending = [n for n in sources if n not in ENTRY_POINTS]
+    while pending:
+        ready = [n for n in pending if all(r in assets for r in references(n, sources[n], pending))]
+        if not ready:
+            raise RuntimeError(f"circular static references: {pending}")
+
+        for name in ready:
+            data = sources[name]
+            if pathlib.PurePosixPath(name).suffix in REWRITE_SUFFIXES:
+                data = rewrite(name, data, assets)
+            sources[name] = data
+            assets[name] = fingerprint(name, data)
+            pending.remove(name)
+
+    outputs = dict((assets[n], sources[n]) for n in assets)
+    for name in ENTRY_POINTS:
+        if name in sources:
+            data = rewrite(name, sources[name], assets)
+            if name == "sw.js":
+                # a new cache name whenever any asset changes
+                version = hashlib.sha256("".join(sorted(assets.values())).encode("utf-8")).hexdigest()[:10]
+                data = re.sub(rb"const VERSION = '[^']*';", b"const VERSION = '" + version.encode("utf-8") + b"';", data)
+            outputs[name] = data
+
+    for name, data in outputs.items():
+        path = DIST / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        compress(path, data)
+
+    (DIST / "assets.json").write_text(json.dumps(assets, indent=4), encoding="utf-8")
+
+    print(f"Built {len(outputs)} static files into {DIST} ({'gzip, brotli' if brotli else 'gzip'})")
+
+
+if __name__ == "__main__":
+    build()
@@ -1,5 +1,7 @@
 var lastRefresh = new Date();
 let refreshInterval = 500; //ms
+let lastListTag = null;
+let streamConnected = false;
 
 //
 // Helpers
@@ -240,15 +242,46 @@ function handleListResponse(data) {
     console.log("Update complete.");
 }
 
+function handleStateResponse(data) {
+    let div = elById(data.id);
+    if (div == null || div.device == null)
+        return;
+
+    let device = Object.assign({}, div.device);
+    device.state = data.state;
+    updateDeviceUi(div, device);
+}
+
+function startStream() {
+    if (!window.EventSource)
+        return;
+
+    let stream = new EventSource('/api/device/stream');
+    stream.addEventListener("open", () => { streamConnected = true; });
+    stream.addEventListener("error", () => { streamConnected = false; });
+    stream.addEventListener("snapshot", (e) => { handleListResponse(JSON.parse(e.data)); });
+    stream.addEventListener("state", (e) => { handleStateResponse(JSON.parse(e.data)); });
+}
+
 function updateData() {
     console.log("Fetching data...");
     lastRefresh = new Date();
     fetch('/api/device/list')
-        .then(response => response.json())
-        .then(data => handleListResponse(data));
+        .then(response => {
+            // the browser revalidates with If-None-Match, unchanged lists skip the ui update
+            let tag = response.headers.get('ETag');
+            if (tag != null && tag == lastListTag)
+                return null;
+            lastListTag = tag;
+            return response.json();
+        })
+        .then(data => { if (data != null) handleListResponse(data); });
 }
 
 function periodicUpdates() {
+    // polling is only a fallback for when the stream is down
+    if (streamConnected)
+        return;
 
     let now = new Date();
     var ms = now - lastRefresh; //in ms
@@ -315,6 +348,12 @@ elById("settings-button").addEventListener("click", () => {
 
 
 updateData();
+startStream();
+
+if ('serviceWorker' in navigator) {
+    navigator.serviceWorker.register('/sw.js')
+        .catch(error => console.log("Service worker not registered: " + error));
+}
 
 window.setInterval(periodicUpdates, 100);
 
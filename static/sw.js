@@ -0,0 +1,71 @@
+//
+// Service Worker
+// - keeps the app shell in a cache so the ui also opens offline
+// - only fingerprinted assets are served cache first, the rest is network first
+// - the build step rewrites the shell list with the fingerprinted names
+//
+const VERSION = 'dev';
+const CACHE = 'magic-wand-' + VERSION;
+
+// name.<hash>.ext, written by scripts/build_static.py
+const FINGERPRINTED = /\.[0-9a-f]{10}\.[^/.]+$/;
+
+const SHELL = [
+    '/index.html',
+    '/app.css',
+    '/app.js',
+    '/open-props.min.css',
+    '/normalize.min.css',
+    '/site.webmanifest',
+    '/icons/settings_black_24dp.svg',
+    '/icons/expand_less_black_48dp.svg',
+    '/icons/stop_black_48dp.svg',
+    '/icons/expand_more_black_48dp.svg',
+    '/icons/more_horiz_black_24dp.svg',
+    '/icons/favicon/favicon-32x32.png',
+    '/icons/favicon/favicon-16x16.png'
+];
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE)
+            .then(cache => cache.addAll(SHELL))
+            .then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key != CACHE).map(key => caches.delete(key))))
+            .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', event => {
+    let request = event.request;
+    let url = new URL(request.url);
+
+    // the api and other origins always go to the network
+    if (request.method != 'GET' || url.origin != self.location.origin || url.pathname.startsWith('/api/'))
+        return;
+
+    // fingerprinted build assets never change, the cache answers them
+    if (FINGERPRINTED.test(url.pathname)) {
+        event.respondWith(
+            caches.match(request).then(cached => cached || fetch(request)));
+        return;
+    }
+
+    // the page and unbuilt assets keep their names between versions,
+    // they come from the network and the cache is only an offline fallback
+    let key = (request.mode == 'navigate' || url.pathname == '/') ? '/index.html' : request;
+    event.respondWith(
+        fetch(request)
+            .then(response => {
+                if (response.ok && !response.redirected) {
+                    let copy = response.clone();
+                    caches.open(CACHE).then(cache => cache.put(key, copy));
+                }
+                return response;
+            })
+            .catch(() => caches.match(key)));
+});
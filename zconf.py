@@ -124,7 +124,7 @@ class ZListener(object):
         self.core = core
 
     def remove_service(self, zeroconf, type_, name):
-        self.core.add_mdns(name)
+        self.core.remove_mdns(name)
         
     def add_service(self, zeroconf, type_, name):
         asyncio.ensure_future(self.found_service(zeroconf, type_, name))